@@ -0,0 +1,357 @@
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from threading import Thread, Event
+from itertools import count
+from util import set_config, to_config, to_service, to_dispatcher
+from state import set_backend, set_state, put_records
+import resource
+import asyncio
+import socket
+import httpx
+import json
+import time
+import util.config
+import sys
+import os
+
+NATION = "greenrainbow"
+SEED_CHUNK = 10000
+# Seconds between memory samples while a scenario runs
+RSS_INTERVAL = 0.01
+# Seconds between checks for background writes still queued
+DRAIN_INTERVAL = 0.01
+M = '/mockup/api/v1'
+SITE = f'{M}/sites/foobar-fake-site/pages'
+
+def to_help(label):
+    if label == 'mode': return 'drive the app in-process, or over a local socket'
+    if label == 'records': return 'people and events seeded before each run'
+    if label == 'requests': return 'requests sent per scenario'
+    if label == 'concurrency': return 'requests in flight at once'
+    if label == 'scenarios': return 'scenarios to run (default all)'
+    if label == 'backend': return 'mockup state backend'
+    if label == 'output': return 'write results as JSON to this file'
+    if label == 'baseline': return 'compare results with this JSON file'
+    if label == 'threshold': return 'allowed slowdown against the baseline'
+    return label
+
+parser = ArgumentParser(
+                    prog='Nationbuilder Benchmark',
+                    description='Load test of the proxy and mockup API',
+                    epilog=f'Using the "{NATION}" nation')
+parser.add_argument('--mode', choices=['inproc', 'socket'], default='inproc', help=to_help('mode'))
+parser.add_argument('--records', type=int, nargs='+', default=[1000], help=to_help('records'))
+parser.add_argument('--requests', type=int, default=2000, help=to_help('requests'))
+parser.add_argument('--concurrency', type=int, default=16, help=to_help('concurrency'))
+parser.add_argument('--scenarios', nargs='+', help=to_help('scenarios'))
+parser.add_argument('--backend', choices=['file', 'journal'], default='journal', help=to_help('backend'))
+parser.add_argument('--output', help=to_help('output'))
+parser.add_argument('--baseline', help=to_help('baseline'))
+parser.add_argument('--threshold', type=float, default=0.2, help=to_help('threshold'))
+
+'''
+Synthetic records
+'''
+
+def to_person(i):
+    return { "person": {
+        "email": f'volunteer{i}@example.com',
+        "last_name": f'Last{i % 1000}',
+        "first_name": f'First{i % 100}',
+        "sex": "F" if i % 2 else "M",
+        "signup_type": 0,
+        "employer": f'Employer{i % 50}',
+        "party": "DRGL"[i % 4],
+        "registered_address": { "state": "MA", "country_code": "US" }
+    }}
+
+def to_event(i):
+    return { "event": {
+        "status": "unlisted",
+        "name": f'Event {i}',
+        "intro": "Benchmark event",
+        "time_zone": "-05:00",
+        "start_time": "2024-01-01T18:00:00-05:00",
+        "end_time": "2024-01-01T20:00:00-05:00",
+        "contact": {
+            "name": "Organizer", "contact_phone": "5555555555",
+            "show_phone": False, "contact_email": "organizer@example.com",
+            "email": "organizer@example.com", "show_email": False
+        },
+        "rsvp_form": {
+            "phone": "optional", "address": "optional", "allow_guests": True,
+            "accept_rsvps": True, "gather_volunteers": False
+        },
+        "show_guests": True,
+        "capacity": 100,
+        "venue": {
+            "name": "Hall",
+            "address": { "address1": "1 Main St", "city": "Boston", "state": "MA" }
+        }
+    }}
+
+def to_survey(i):
+    return { "survey": {
+        "slug": f'survey-{i}', "name": f'Survey {i}', "status": "published",
+        "tags": ["benchmark"], "questions": []
+    }}
+
+def to_basic_page(i):
+    return { "basic_page": {
+        "name": f'Page {i}', "content": "Benchmark page", "status": "published"
+    }}
+
+def to_contact(i):
+    return { "contact": {
+        "type_id": 1, "sender_id": 1, "person_id": i,
+        "status": "answered", "method": "door_knock", "note": "Benchmark"
+    }}
+
+def seed(records):
+    set_state('session', token='bench')
+    for key, make in [("persons", to_person), ("events", to_event)]:
+        for start in range(0, records, SEED_CHUNK):
+            end = min(start + SEED_CHUNK, records)
+            pairs = [(i, with_id(make(i), i)) for i in range(start, end)]
+            put_records(key, pairs)
+
+def with_id(record, uid):
+    item = next(iter(record.values()))
+    item["id"] = uid
+    return record
+
+'''
+Scenarios, one request each
+'''
+
+def to_scenarios(records):
+    n = lambda i: i % records
+    return {
+        "people-list": lambda c, i: c.get(f'{M}/people', params={ 'format': 'json' }),
+        "people-match": lambda c, i: c.get(f'{M}/people/match', params={
+            'format': 'json', 'email': f'volunteer{n(i)}@example.com'
+        }),
+        "people-create": lambda c, i: c.post(f'{M}/people', json=to_person(records + i)),
+        "people-update": lambda c, i: c.put(f'{M}/people/{n(i)}', json=to_person(n(i))),
+        "events-list": lambda c, i: c.get(f'{M}/pages/events', params={ 'format': 'json' }),
+        "events-create": lambda c, i: c.post(f'{M}/pages/events', json=to_event(i)),
+        "events-update": lambda c, i: c.put(f'{M}/pages/events/{n(i)}', json=to_event(n(i))),
+        "surveys": lambda c, i: c.post(f'{SITE}/surveys', json=to_survey(i)),
+        "basic-pages": lambda c, i: c.post(f'{SITE}/basic_pages', json=to_basic_page(i)),
+        "contacts": lambda c, i: c.post(f'{M}/people/{n(i)}/contacts', json=to_contact(i)),
+        "proxy-people-list": lambda c, i: c.get('/api/people'),
+        "proxy-people-update": lambda c, i: c.put(f'/api/people/{n(i)}', json=to_person(n(i))),
+        "proxy-events-create": lambda c, i: c.post('/api/pages/events', json=to_event(i)),
+        "oauth-redirect": lambda c, i: c.post('/api/redirect', json={ 'code': f'bench-{i}' }),
+        "people-delete": lambda c, i: c.delete(f'{M}/people/{records - 1 - n(i)}')
+    }
+
+async def run_scenario(client, call, requests, concurrency):
+    latencies, errors, sampler = [], 0, RssSampler()
+    counter = count()
+    async def worker():
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if i >= requests: return
+            start = time.perf_counter()
+            try:
+                r = await call(client, i)
+                if r.status_code >= 400: errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+    return to_summary(latencies, errors, elapsed, sampler.peak)
+
+async def drain(config):
+    # Background writes from one scenario would slow down the next
+    dispatcher = to_dispatcher(config)
+    while dispatcher.pending:
+        await asyncio.sleep(DRAIN_INTERVAL)
+
+def to_summary(latencies, errors, elapsed, peak):
+    latencies = sorted(latencies)
+    def percentile(p):
+        if not latencies: return None
+        i = min(len(latencies) - 1, int(p * len(latencies)))
+        return round(latencies[i] * 1000, 3)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "peak_rss_mb": round(peak / 2 ** 20, 1)
+    }
+
+class RssSampler(Thread):
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = to_rss()
+        self.stopped = Event()
+
+    def run(self):
+        # Polled, since the process-wide high-water mark never comes down
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, to_rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, to_rss())
+
+def to_rss():
+    # Current resident bytes, where /proc has them
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    # Elsewhere, only the peak so far: kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+'''
+Clients, in-process or over a socket
+'''
+
+def to_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def configure(root, port):
+    # Leave the env.json written by test.py alone
+    util.config.CONFIG = os.path.join(root, 'env.json')
+    set_config(**{
+        "local": True, "port": port, "nation": NATION,
+        "protocol": "http://", "client_id": "local", "client_secret": "local",
+        "redirect": f'http://localhost:{port}/api/redirect',
+        # The harness measures the app, not upstream throttling
+        "rate_limit": 1e6, "rate_burst": 1000000, "mock_rate_limit": 0.0,
+        "queue_size": 1000000, "cache_ttl": 0.0
+    })
+    to_config.cache_clear()
+    return to_config()
+
+def to_inproc_client(app, config):
+    origin = f'http://localhost:{config.port}'
+    # Proxy calls reach the mockup without leaving the process
+    service = to_service(config)
+    transport = httpx.ASGITransport(app=app)
+    service.client = httpx.AsyncClient(**{
+        "transport": transport, "base_url": origin,
+        "headers": {'content-type': 'application/json'}
+    })
+    return httpx.AsyncClient(transport=transport, base_url=origin)
+
+def start_server(app, port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(**{
+        "app": app, "port": port, "host": "127.0.0.1",
+        "log_level": "warning", "lifespan": "off"
+    }))
+    thread = Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started: time.sleep(0.01)
+    return server, thread
+
+async def run_all(app, config, names, scenarios, args):
+    results = {}
+    if args.mode == 'inproc':
+        client = to_inproc_client(app, config)
+    else:
+        origin = f'http://127.0.0.1:{config.port}'
+        limits = httpx.Limits(max_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=origin, limits=limits)
+    async with client:
+        for name in names:
+            call = scenarios[name]
+            results[name] = await run_scenario(**{
+                "client": client, "call": call,
+                "requests": args.requests, "concurrency": args.concurrency
+            })
+            await drain(config)
+            print(f'{name}: {json.dumps(results[name])}', file=sys.stderr)
+    if args.mode == 'inproc':
+        await to_service(config).close()
+    return results
+
+def run(records, args):
+    with TemporaryDirectory() as root:
+        set_backend(args.backend, root)
+        config = configure(root, to_port())
+        seed(records)
+        from mockup import nationbuilder
+        scenarios = to_scenarios(records)
+        names = args.scenarios or list(scenarios)
+        unknown = [name for name in names if name not in scenarios]
+        if unknown: raise SystemExit(f'Unknown scenarios: {", ".join(unknown)}')
+        server = None
+        if args.mode == 'socket':
+            server, thread = start_server(nationbuilder, config.port)
+        try:
+            return asyncio.run(run_all(nationbuilder, config, names, scenarios, args))
+        finally:
+            if server is not None:
+                server.should_exit = True
+                thread.join()
+
+'''
+Baseline comparison
+'''
+
+def to_regressions(results, baseline, threshold):
+    regressions = []
+    for run_key, scenarios in results["runs"].items():
+        for name, now in scenarios.items():
+            before = baseline.get("runs", {}).get(run_key, {}).get(name, None)
+            if before is None: continue
+            label = f'{run_key} {name}'
+            rps, old_rps = now["throughput"], before["throughput"]
+            p95, old_p95 = now["p95_ms"], before["p95_ms"]
+            if rps < old_rps * (1 - threshold):
+                regressions.append(f'{label}: throughput {old_rps} -> {rps}')
+            if p95 > old_p95 * (1 + threshold):
+                regressions.append(f'{label}: p95 {old_p95}ms -> {p95}ms')
+    return regressions
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    results = {
+        "meta": {
+            "mode": args.mode,
+            "backend": args.backend,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "python": sys.version.split()[0],
+            "started_at": time.time()
+        },
+        "runs": {}
+    }
+    for records in args.records:
+        results["runs"][f'records={records}'] = run(records, args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output)
+    else:
+        print(output)
+    # Fail when any scenario is slower than the baseline allows
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.loads(f.read())
+        regressions = to_regressions(results, baseline, args.threshold)
+        for regression in regressions: print(f'Regression: {regression}', file=sys.stderr)
+        if regressions: sys.exit(1)
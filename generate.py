@@ -0,0 +1,238 @@
+from argparse import ArgumentParser
+from tempfile import NamedTemporaryFile
+from pathlib import Path
+from state import set_backend, set_state, to_state, to_lock, to_seq
+from models import HasPerson, HasEvent, HasSurvey, HasBasicPage, HasContact
+from models import HasChange
+import random
+import json
+import time
+import os
+
+# Records generated from one random state, and written at once
+CHUNK = 1000
+FIRST_NAMES = [
+    "Ada", "Alex", "Amara", "Ana", "Ben", "Carlos", "Chen", "Dana", "Deshawn",
+    "Elena", "Emma", "Farah", "Grace", "Hana", "Ivan", "James", "Jin", "Kai",
+    "Laila", "Leo", "Maria", "Mateo", "Mei", "Noah", "Olivia", "Omar", "Priya",
+    "Quinn", "Rosa", "Sam", "Sofia", "Tariq", "Uma", "Victor", "Wei", "Yara", "Zoe"
+]
+LAST_NAMES = [
+    "Adams", "Baker", "Brown", "Chen", "Clark", "Davis", "Diaz", "Evans", "Garcia",
+    "Green", "Hall", "Harris", "Hill", "Jackson", "Johnson", "Jones", "Kim", "Lee",
+    "Lewis", "Lopez", "Martin", "Miller", "Moore", "Nguyen", "Patel", "Perez",
+    "Robinson", "Rodriguez", "Scott", "Smith", "Taylor", "Thomas", "Thompson",
+    "Walker", "White", "Williams", "Wilson", "Wright", "Young"
+]
+STATES = [
+    "AL", "AK", "AZ", "CA", "CO", "CT", "FL", "GA", "IL", "MA", "MD", "MI",
+    "MN", "NC", "NJ", "NY", "OH", "OR", "PA", "TX", "VA", "WA", "WI"
+]
+PARTIES = ["D", "R", "G", "L", "I", "U"]
+CITIES = ["Springfield", "Riverside", "Franklin", "Greenville", "Fairview", "Madison"]
+STREETS = ["Main St", "Oak Ave", "Maple Dr", "Cedar Ln", "Park Rd", "Elm St"]
+METHODS = ["door_knock", "phone_call", "email", "text", "meeting"]
+STATUSES = ["answered", "no_answer", "left_message", "refused", "meaningful_interaction"]
+
+def to_help(label):
+    if label == 'people': return 'people in the nation'
+    if label == 'contacts': return 'average contacts logged per person'
+    if label == 'events': return 'events (default one per 1000 people)'
+    if label == 'surveys': return 'surveys (default one per 10000 people)'
+    if label == 'basic-pages': return 'basic pages'
+    if label == 'seed': return 'seed; the same seed gives the same nation'
+    if label == 'dir': return 'state directory to replace collections in'
+    if label == 'backend': return 'state backend the directory is read with'
+    return label
+
+parser = ArgumentParser(
+                    prog='Nationbuilder Generator',
+                    description='Seed the mockup state with a synthetic nation')
+parser.add_argument('--people', type=int, default=10000, help=to_help('people'))
+parser.add_argument('--contacts', type=float, default=3.0, help=to_help('contacts'))
+parser.add_argument('--events', type=int, help=to_help('events'))
+parser.add_argument('--surveys', type=int, help=to_help('surveys'))
+parser.add_argument('--basic-pages', type=int, default=20, help=to_help('basic-pages'))
+parser.add_argument('--seed', type=int, default=0, help=to_help('seed'))
+parser.add_argument('--dir', default=str(Path(__file__).parent / 'state'), help=to_help('dir'))
+parser.add_argument('--backend', choices=['file', 'journal'], default='journal', help=to_help('backend'))
+
+'''
+Records, one chunk at a time
+'''
+
+def to_name(rng):
+    return rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+
+def to_people(rng, start, end, employers):
+    for uid in range(start, end):
+        first, last = to_name(rng)
+        yield { "person": {
+            "email": f'{first}.{last}.{uid}@example.org'.lower(),
+            "last_name": last,
+            "first_name": first,
+            "id": uid,
+            "sex": rng.choice("FMO"),
+            "signup_type": rng.choice([0, 0, 0, 1]),
+            "employer": f'Employer {rng.randrange(employers)}',
+            "party": rng.choice(PARTIES),
+            "registered_address": {
+                "state": rng.choice(STATES), "country_code": "US"
+            }
+        }}
+
+def to_contacts(rng, start, end, people, most):
+    for uid in range(start, end):
+        # Ids are spaced by the most contacts any one person can have
+        for n in range(rng.randint(0, most)):
+            yield { "contact": {
+                "id": uid * most + n,
+                "type_id": rng.randint(1, 10),
+                "sender_id": rng.randrange(people),
+                "person_id": uid,
+                "status": rng.choice(STATUSES),
+                "method": rng.choice(METHODS),
+                "note": rng.choice(["", "Interested in volunteering", "Call back later"])
+            }}
+
+def to_events(rng, start, end):
+    for uid in range(start, end):
+        first, last = to_name(rng)
+        day = rng.randint(1, 28)
+        month = rng.randint(1, 12)
+        hour = rng.randint(9, 19)
+        when = f'2024-{month:02d}-{day:02d}T{hour:02d}:00:00-05:00'
+        until = f'2024-{month:02d}-{day:02d}T{hour + 2:02d}:00:00-05:00'
+        email = f'{first}.{last}@example.org'.lower()
+        yield { "event": {
+            "status": rng.choice(["published", "unlisted"]),
+            "name": f'{rng.choice(CITIES)} canvass {uid}',
+            "intro": "Join neighbors to talk with voters.",
+            "id": uid,
+            "time_zone": "-05:00",
+            "start_time": when,
+            "end_time": until,
+            "contact": {
+                "name": f'{first} {last}',
+                "contact_phone": f'555{rng.randrange(10 ** 7):07d}',
+                "show_phone": rng.random() < 0.5,
+                "contact_email": email,
+                "email": email,
+                "show_email": rng.random() < 0.5
+            },
+            "rsvp_form": {
+                "phone": "optional", "address": "optional",
+                "allow_guests": rng.random() < 0.7,
+                "accept_rsvps": True,
+                "gather_volunteers": rng.random() < 0.3
+            },
+            "show_guests": rng.random() < 0.5,
+            "capacity": rng.choice([0, 10, 25, 50, 100]),
+            "venue": {
+                "name": f'{rng.choice(CITIES)} Library',
+                "address": {
+                    "address1": f'{rng.randint(1, 999)} {rng.choice(STREETS)}',
+                    "city": rng.choice(CITIES),
+                    "state": rng.choice(STATES)
+                }
+            }
+        }}
+
+def to_surveys(rng, start, end):
+    for uid in range(start, end):
+        yield { "survey": {
+            "slug": f'survey-{uid}',
+            "name": f'Survey {uid}',
+            "status": rng.choice(["published", "unlisted"]),
+            "tags": rng.sample(["canvass", "phonebank", "issues", "volunteer"], 2),
+            "id": uid,
+            "questions": [{
+                "prompt": f'Question {n + 1}?',
+                "slug": f'survey-{uid}-q{n + 1}',
+                "type": "multiple",
+                "status": "published",
+                "choices": [{ "name": c } for c in ["Yes", "No", "Unsure"]]
+            } for n in range(rng.randint(1, 4))]
+        }}
+
+def to_basic_pages(rng, start, end):
+    for uid in range(start, end):
+        yield { "basic_page": {
+            "name": f'Page {uid}',
+            "id": uid,
+            "content": f'<p>{rng.choice(CITIES)} update {uid}</p>',
+            "status": rng.choice(["published", "unlisted"])
+        }}
+
+'''
+Streaming into state/
+'''
+
+def to_chunks(seed, key, count):
+    # Each chunk has its own random state, so output does not depend on order
+    for start in reversed(range(0, count, CHUNK)):
+        end = min(start + CHUNK, count)
+        yield random.Random(f'{seed}-{key}-{start}'), start, end
+
+def write_collection(root, key, model, chunks):
+    total = 0
+    with to_lock(key):
+        # A later seq, so running workers reload rather than catch up
+        seq = to_seq(key)
+        with NamedTemporaryFile('w', dir=root, delete=False) as f:
+            f.write(f'{{"{key}": [')
+            for records in chunks:
+                # Snapshots list the newest records first
+                records = list(records)[::-1]
+                if total == 0 and records: model.parse_obj(records[0])
+                text = ',\n'.join(json.dumps(e) for e in records)
+                if not text: continue
+                f.write((',\n' if total else '\n') + text)
+                total += len(records)
+            f.write(']}' if seq is None else f'], "seq": {seq + 1}}}')
+        os.replace(f.name, root.joinpath(f'{key}.json'))
+        # The new snapshot replaces any journaled history
+        for suffix in ('', '.old'):
+            journal = root.joinpath(f'{key}.journal{suffix}')
+            if journal.exists(): journal.unlink()
+    return total
+
+def generate(root, args):
+    people, seed = args.people, args.seed
+    events = max(1, people // 1000) if args.events is None else args.events
+    surveys = max(1, people // 10000) if args.surveys is None else args.surveys
+    employers = max(1, people // 50)
+    # Between none and twice the average contacts per person
+    most = round(2 * args.contacts)
+    plan = [
+        ("persons", HasPerson, people, lambda rng, s, e: to_people(rng, s, e, employers)),
+        ("contacts", HasContact, people, lambda rng, s, e: to_contacts(rng, s, e, people, most)),
+        ("events", HasEvent, events, to_events),
+        ("surveys", HasSurvey, surveys, to_surveys),
+        ("basic_pages", HasBasicPage, args.basic_pages, to_basic_pages)
+    ]
+    counts = {}
+    for key, model, count, make in plan:
+        started = time.time()
+        chunks = (make(rng, s, e) for rng, s, e in to_chunks(seed, key, count))
+        counts[key] = write_collection(root, key, model, chunks)
+        print(f'{key}: {counts[key]} records in {time.time() - started:.1f}s')
+    # Changes to the replaced people and events no longer apply
+    write_collection(root, "changes", HasChange, [])
+    # New records continue after the generated ids
+    sequences = to_state('sequences')
+    sequences = {} if sequences is None else sequences.dict()
+    set_state('sequences', **{
+        **sequences, "persons": people, "events": events,
+        "surveys": surveys, "basic_pages": args.basic_pages,
+        "contacts": people * most
+    })
+    return counts
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    root = Path(args.dir).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    set_backend(args.backend, root)
+    generate(root, args)
@@ -1,17 +1,43 @@
 from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY as _422
 from starlette.status import HTTP_204_NO_CONTENT as _204
+from starlette.status import HTTP_404_NOT_FOUND as _404
+from starlette.status import HTTP_400_BAD_REQUEST as _400
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS as _429
 from starlette.status import HTTP_201_CREATED as _201
+from starlette.status import HTTP_502_BAD_GATEWAY as _502
+from starlette.status import HTTP_304_NOT_MODIFIED as _304
 from fastapi.exceptions import RequestValidationError
-from concurrent.futures import ThreadPoolExecutor
 from fastapi.exceptions import HTTPException
-from starlette.responses import FileResponse 
 from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from starlette.requests import Request
 from util import to_service, to_config
+from util import to_dispatcher, QueueFull
+from util import UpstreamError, Bucket
+from util import to_response_cache
+from util import to_token_store
+from util import to_asset
+from util import to_metrics
+from util import to_profiler
+from util import to_broker, to_sse
+from util import to_coalescer
 from state import set_state, to_state
-from fastapi import Depends, FastAPI
-from urllib.parse import parse_qs
-from pydantic import BaseModel
+from state import put_records, to_next_ids
+from state import to_record, to_page_bytes
+from state import to_revision
+from state import to_matches
+from state import to_changes, to_record_bytes
+from state import to_finished_jobs, to_last_id
+from state import to_cache_stats, to_io_stats
+from state import to_lock
+from state import submit_write, submit_call, NEW
+from state import to_commit_stats
+from state import ITEMS, TRACKED
+from fastapi import Depends, FastAPI, Query, Response
+from urllib.parse import parse_qs, urlencode
+from pydantic import BaseModel, ValidationError
+from datetime import datetime
+from uuid import uuid4
 from models import HasBasicPage
 from models import HasContact
 from models import HasSurvey
@@ -19,97 +45,378 @@ from models import HasPerson
 from models import HasEvent
 import requests
 import asyncio
+import hashlib
+import base64
 import json
+import httpx
+import math
+import time
+import os
+
+# Upstream bulk requests carry at most this many records
+BULK_CHUNK = 100
+
+# Seconds after startup before warming up OAuth and assets
+WARM_UP_DELAY = 0.5
+IMPORTED_AT = time.time()
 
 # Construct mockup API
 nationbuilder = FastAPI()
-pool = ThreadPoolExecutor(max_workers=1)
 
-# Call Nationbuilder (or local mockup)
+async def warm_up(config):
+    # Compress static assets before the first page load
+    to_asset('static/index.html', STATIC_SCRIPTS)
+    # A stored token is enough; otherwise call Nationbuilder (or local mockup)
+    if await to_token(config) is not None: return
+    service = to_service(config)
+    try:
+        await service.to_client().get(service.authorize_url)
+    except httpx.HTTPError as e:
+        print(f'OAuth warm-up failed: {type(e).__name__}: {e}')
+
 @nationbuilder.on_event("startup")
-def startup_event():
-    async def startup(config):
-        requests.get(to_service(config).authorize_url)
-    # Submit request in parallel
-    pool.submit(asyncio.run, startup(to_config()))
+async def startup_event():
+    config = to_config()
+    # Serve first, warm up once the worker is accepting requests
+    loop = asyncio.get_running_loop()
+    loop.call_later(WARM_UP_DELAY, lambda: asyncio.ensure_future(warm_up(config)))
+    to_dispatcher(config).listeners.append(lambda job: record_job(config, job))
+    started = config.launched_at or IMPORTED_AT
+    print(f'Worker {os.getpid()} started in {time.time() - started:.3f}s')
+
+@nationbuilder.on_event("shutdown")
+async def shutdown_event():
+    await to_service(to_config()).close()
 
 '''
 Incidental helpers
 '''
-def to_token():
+def load_session():
     session = to_state("session")
     if session is None: return None
-    return session.token
+    return session.dict(exclude_none=True)
+
+def save_session(session):
+    set_state('session', **session)
+
+def to_tokens(config):
+    return to_token_store(to_service(config), load_session, save_session)
+
+async def to_token(config):
+    return await to_tokens(config).get()
 
 class HasCode(BaseModel):
     code: str
 
+def to_write(config, resource, make):
+    cache = to_response_cache(config)
+    # Drop cached lists now and once the write lands upstream
+    async def write():
+        try:
+            return await make()
+        finally:
+            if resource is not None: cache.invalidate(resource)
+    if resource is not None: cache.invalidate(resource)
+    return write
+
+def to_job(config, resource, target, response, make, delay=0.0):
+    try:
+        write = to_write(config, resource, make)
+        job = to_dispatcher(config).submit(target, write, delay)
+    except QueueFull:
+        detail = 'Too many queued writes'
+        headers = { 'Retry-After': '1' }
+        raise HTTPException(status_code=_429, detail=detail, headers=headers)
+    response.headers['Location'] = f'/api/jobs/{job.id}'
+    return { "job": job.to_dict() }
+
+def to_update_job(config, resource, target, response, e):
+    update = e.dict(exclude_unset=True)
+    async def put():
+        data = json.dumps(update).encode('utf-8')
+        return await to_service(config).put_api(await to_token(config), target, data)
+    coalescer = to_coalescer(config)
+    if coalescer.window <= 0:
+        return to_job(config, resource, target, response, put)
+    # Bursts of updates to one record are sent as one merged PUT
+    dispatcher = to_dispatcher(config)
+    job = dispatcher.to_job(coalescer.to_held(target))
+    # Later writes, such as deletes, must not be overtaken
+    if job is not None and dispatcher.is_last(target, job):
+        coalescer.merge(resource, target, update)
+        to_response_cache(config).invalidate(resource)
+        response.headers['Location'] = f'/api/jobs/{job.id}'
+        return { "job": job.to_dict() }
+    job_id = None
+    async def put_merged():
+        coalescer.release(target, job_id)
+        data = json.dumps(update).encode('utf-8')
+        return await to_service(config).put_api(await to_token(config), target, data)
+    result = to_job(config, resource, target, response, put_merged, coalescer.window)
+    job_id = result["job"]["id"]
+    coalescer.hold(target, job_id, update)
+    return result
+
+async def to_bulk_items(request, model):
+    body = (await request.body()).decode('utf-8')
+    content_type = request.headers.get('content-type', '')
+    try:
+        if 'ndjson' in content_type:
+            items = [json.loads(l) for l in body.splitlines() if l.strip()]
+        else:
+            items = json.loads(body)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=_400, detail=f'Invalid JSON: {e}')
+    if not isinstance(items, list):
+        raise HTTPException(status_code=_400, detail='Expected a list')
+    valid, errors = [], {}
+    for i, item in enumerate(items):
+        try:
+            valid.append((i, model.parse_obj(item).json().encode('utf-8')))
+        except ValidationError as e:
+            errors[i] = { "status": _422, "error": e.errors() }
+    return len(items), valid, errors
+
+async def to_bulk_results(config, url, count, valid, errors):
+    dispatcher = to_dispatcher(config)
+    chunks = [valid[i:i+BULK_CHUNK] for i in range(0, len(valid), BULK_CHUNK)]
+    if not dispatcher.has_room(len(chunks)):
+        detail = 'Too many queued writes'
+        headers = { 'Retry-After': '1' }
+        raise HTTPException(status_code=_429, detail=detail, headers=headers)
+    def to_post(chunk):
+        # Validated items are already serialized, so join their bytes
+        data = b'[' + b','.join(item for _, item in chunk) + b']'
+        async def post():
+            token = await to_token(config)
+            return await to_service(config).post_api(token, url, data)
+        return to_write(config, url.removesuffix('/bulk'), post)
+    jobs = [dispatcher.submit(None, to_post(chunk)) for chunk in chunks]
+    responses = await asyncio.gather(*[job.task for job in jobs])
+    results = { **errors }
+    for chunk, job, r in zip(chunks, jobs, responses):
+        if r is None or r.status_code >= 400:
+            error = job.error or 'Upstream write failed'
+            failed = { "status": job.status_code or 502, "error": error }
+            results.update({ i: failed for i, _ in chunk })
+            continue
+        upstream = r.json()["results"]
+        results.update({ i: e for (i, _), e in zip(chunk, upstream) })
+    return { "results": [{ "index": i, **results[i] } for i in range(count)] }
+
+def is_fresh(request, etag):
+    tags = request.headers.get('if-none-match', '')
+    tags = [t.strip().removeprefix('W/') for t in tags.split(',')]
+    return etag in tags or '*' in tags
+
+def to_etag(etags):
+    # One tag per upstream page, combined for the whole list
+    if not etags or None in etags: return None
+    if len(etags) == 1: return etags[0]
+    digest = hashlib.sha1(''.join(etags).encode('utf-8')).hexdigest()
+    return f'"{digest}"'
+
+def to_body(request, body, etag):
+    headers = { 'Cache-Control': 'no-cache' }
+    if etag is not None:
+        headers['ETag'] = etag
+        if is_fresh(request, etag):
+            return Response(status_code=_304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+async def to_list(config, endpoint, request, params=None, resource=None):
+    token = await to_token(config)
+    params = params or {}
+    # Cached until a write to the listed resource
+    resource = resource or endpoint
+    key = (token, endpoint, tuple(sorted(params.items())))
+    cache = to_response_cache(config)
+    cached = cache.get(key)
+    if cached is not None:
+        return to_body(request, *cached)
+    etags = []
+    generation = cache.to_generation(resource)
+    def on_done(body):
+        cache.set(key, resource, body, generation, to_etag(etags))
+    pages = to_service(config).iter_api(**{
+        "token": token, "endpoint": endpoint, "etags": etags, "params": params
+    })
+    if 'if-none-match' not in request.headers:
+        # Nothing is held in memory while caching is off
+        if cache.ttl <= 0: on_done = None
+        return await to_stream(pages, on_done, cache.max_bytes)
+    # Revalidation waits for every page, which are mostly upstream 304s
+    body = b''.join([chunk async for chunk in to_chunks(pages)])
+    on_done(body)
+    return to_body(request, body, to_etag(etags))
+
+async def to_chunks(pages, first=None):
+    yield b'{"results": ['
+    sep = b''
+    if first:
+        yield json.dumps(first)[1:-1].encode('utf-8')
+        sep = b','
+    async for results in pages:
+        if not results: continue
+        yield sep + json.dumps(results)[1:-1].encode('utf-8')
+        sep = b','
+    yield b']}'
+
+async def to_stream(pages, on_done=None, max_bytes=None):
+    # Errors on the first page can still set the status code
+    try:
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = []
+    async def stream():
+        body, size, kept = [], 0, on_done is not None
+        async for chunk in to_chunks(pages, first):
+            if kept:
+                size += len(chunk)
+                # Lists too big to cache are passed through, not held
+                kept = max_bytes is None or size <= max_bytes
+                if kept: body.append(chunk)
+                else: body = []
+            yield chunk
+        if kept: on_done(b''.join(body))
+    # Untagged, as a tag for the whole list needs every page. Once
+    # cached, the list is served with the tag revalidation checks.
+    headers = { 'Cache-Control': 'no-cache' }
+    media_type = 'application/json'
+    return StreamingResponse(stream(), media_type=media_type, headers=headers)
+
 '''
 Client-side single page app
 '''
 
+STATIC_SCRIPTS = ('static/index.js', 'static/country_code.js')
+
+def to_static(request, path, links=()):
+    asset = to_asset(path, links)
+    encoding = asset.to_encoding(request.headers.get('accept-encoding'))
+    etag = asset.to_etag(encoding)
+    version = request.query_params.get('v', None)
+    headers = {
+        'Cache-Control': asset.to_cache_control(version),
+        'Vary': 'Accept-Encoding',
+        'ETag': etag
+    }
+    if is_fresh(request, etag):
+        return Response(status_code=_304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    body = asset.bodies[encoding]
+    return Response(body, media_type=asset.media_type, headers=headers)
+
 @nationbuilder.get("/")
-async def open_root_html():
-    return FileResponse('static/index.html')
+async def open_root_html(request: Request):
+    return to_static(request, 'static/index.html', STATIC_SCRIPTS)
 
 @nationbuilder.get("/index.js")
-async def open_root_js():
-    return FileResponse('static/index.js')
+async def open_root_js(request: Request):
+    return to_static(request, 'static/index.js')
 
 @nationbuilder.get("/country_code.js")
-async def open_country_code():
-    return FileResponse('static/country_code.js')
+async def open_country_code(request: Request):
+    return to_static(request, 'static/country_code.js')
 
 '''
 Proxy to fetch real/mocked Nationbuilder endpoints
 '''
 
 @nationbuilder.get("/api")
-def open_root_api(config=Depends(to_config)):
-    oauth = to_service(config).oauth
-    token = to_token()
+async def open_root_api(config=Depends(to_config)):
+    token = await to_token(config)
     if token is None: return vars(config)
     return { **vars(config), "token": token }
 
+'''
+Job
+'''
+
+@nationbuilder.get("/api/jobs")
+async def list_jobs(config=Depends(to_config)):
+    return {
+        "queue": to_dispatcher(config).to_stats(),
+        "coalesced": to_coalescer(config).to_stats()
+    }
+
+@nationbuilder.get("/api/cache")
+async def read_cache(config=Depends(to_config)):
+    return { "cache": to_response_cache(config).to_stats() }
+
+@nationbuilder.get("/api/jobs/{job_id}")
+async def read_job(job_id: str, config=Depends(to_config)):
+    dispatcher = to_dispatcher(config)
+    job = dispatcher.to_job(job_id)
+    if job is None: raise HTTPException(status_code=_404)
+    return { "job": job.to_dict(), "queue": dispatcher.to_stats() }
+
 '''
 Person
 '''
 
 @nationbuilder.delete("/api/people/{who}", status_code=_204)
 async def delete_person(
-        who: int, config=Depends(to_config), token=to_token()
+        who: int, response: Response,
+        config=Depends(to_config)
     ):
     async def delete_person():
         url = f'/people/{who}'
-        await to_service(config).delete_api(to_token(), url)
+        return await to_service(config).delete_api(await to_token(config), url)
     # Submit request in parallel
-    pool.submit(asyncio.run, delete_person())
+    to_job(config, '/people', f'/people/{who}', response, delete_person)
 
 @nationbuilder.put("/api/people/{who}")
 async def update_person(
-        who: int, e: HasPerson, config=Depends(to_config), token=to_token()
+        who: int, e: HasPerson, response: Response,
+        config=Depends(to_config)
     ):
-    async def put_person():
-        url = f'/people/{who}'
-        data = json.loads(e.json())
-        await to_service(config).put_api(to_token(), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, put_person())
+    return to_update_job(config, '/people', f'/people/{who}', response, e)
 
 @nationbuilder.post("/api/people", status_code=_201)
 async def create_person(
-        e: HasPerson, config=Depends(to_config), token=to_token()
+        e: HasPerson, response: Response,
+        config=Depends(to_config)
     ):
     async def post_person():
         url = '/people'
-        data = json.loads(e.json())
-        await to_service(config).post_api(to_token(), url, data)
+        data = e.json().encode('utf-8')
+        return await to_service(config).post_api(await to_token(config), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, post_person())
+    return to_job(config, '/people', None, response, post_person)
+
+@nationbuilder.post("/api/people/bulk")
+async def bulk_persons(request: Request, config=Depends(to_config)):
+    count, valid, errors = await to_bulk_items(request, HasPerson)
+    return await to_bulk_results(config, '/people/bulk', count, valid, errors)
 
 @nationbuilder.get("/api/people")
-def list_persons(config=Depends(to_config), token=to_token()):
-    return to_service(config).get_api(to_token(), '/people')
+async def list_persons(
+        request: Request, config=Depends(to_config)
+    ):
+    return await to_list(config, '/people', request)
+
+@nationbuilder.get("/api/people/match")
+async def match_person(email: str, config=Depends(to_config)):
+    token = await to_token(config)
+    service = to_service(config)
+    try:
+        return await service.get_api(token, '/people/match', params={
+            "email": email
+        })
+    except UpstreamError as e:
+        if e.status_code != _400: raise
+        # No match, or several, is reported as Nationbuilder does
+        return Response(e.detail, status_code=_400, media_type='application/json')
+
+@nationbuilder.get("/api/people/search")
+async def search_persons(
+        request: Request, config=Depends(to_config)
+    ):
+    params = to_search(request)
+    return await to_list(config, '/people/search', request, params, '/people')
 
 '''
 Survey
@@ -117,20 +424,23 @@ Survey
 
 @nationbuilder.post("/api/surveys", status_code=_201)
 async def create_survey(
-        e: HasSurvey, config=Depends(to_config), token=to_token()
+        e: HasSurvey, response: Response,
+        config=Depends(to_config)
     ):
+    url = '/sites/foobar-fake-site/pages/surveys'
     async def post_survey():
-        url = '/sites/foobar-fake-site/pages/surveys'
-        data = json.loads(e.json())
-        await to_service(config).post_api(to_token(), url, data)
+        data = e.json().encode('utf-8')
+        return await to_service(config).post_api(await to_token(config), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, post_survey())
+    return to_job(config, url, None, response, post_survey)
 
 
 @nationbuilder.get("/api/surveys")
-def list_surveys(config=Depends(to_config), token=to_token()):
+async def list_surveys(
+        request: Request, config=Depends(to_config)
+    ):
     url = '/sites/foobar-fake-site/pages/surveys'
-    return to_service(config).get_api(to_token(), url)
+    return await to_list(config, url, request)
 
 
 '''
@@ -139,19 +449,22 @@ Basic Page
 
 @nationbuilder.post("/api/basic_pages", status_code=_201)
 async def create_basic_page(
-        e: HasBasicPage, config=Depends(to_config), token=to_token()
+        e: HasBasicPage, response: Response,
+        config=Depends(to_config)
     ):
+    url = '/sites/foobar-fake-site/pages/basic_pages'
     async def post_basic_page():
-        url = '/sites/foobar-fake-site/pages/basic_pages'
-        data = json.loads(e.json())
-        await to_service(config).post_api(to_token(), url, data)
+        data = e.json().encode('utf-8')
+        return await to_service(config).post_api(await to_token(config), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, post_basic_page())
+    return to_job(config, url, None, response, post_basic_page)
 
 @nationbuilder.get("/api/basic_pages")
-def list_basic_pages(config=Depends(to_config), token=to_token()):
+async def list_basic_pages(
+        request: Request, config=Depends(to_config)
+    ):
     url = '/sites/foobar-fake-site/pages/basic_pages'
-    return to_service(config).get_api(to_token(), url)
+    return await to_list(config, url, request)
 
 
 '''
@@ -160,14 +473,38 @@ Contact
 
 @nationbuilder.post("/api/people/{who}/contacts", status_code=_201)
 async def create_contact(
-        who: int, e: HasContact, config=Depends(to_config), token=to_token()
+        who: int, e: HasContact, response: Response,
+        config=Depends(to_config)
     ):
+    url = f'/people/{who}/contacts'
     async def post_contact():
-        url = f'/people/{who}/contacts'
-        data = json.loads(e.json())
-        await to_service(config).post_api(to_token(), url, data)
+        data = e.json().encode('utf-8')
+        return await to_service(config).post_api(await to_token(config), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, post_contact())
+    return to_job(config, url, f'/people/{who}', response, post_contact)
+
+def to_next_token(link):
+    # Nationbuilder's next links carry the cursor as __token
+    if not link: return None
+    query = parse_qs(link.partition('?')[2])
+    return query.get('__token', [None])[0]
+
+@nationbuilder.get("/api/people/{who}/contacts")
+async def list_contacts(
+        who: int, limit: int = None,
+        cursor: str = Query(None, alias='__token'), config=Depends(to_config)
+    ):
+    token = await to_token(config)
+    endpoint = f'/people/{who}/contacts'
+    params = {} if limit is None else { "limit": limit }
+    if cursor is not None: params['__token'] = cursor
+    page = await to_service(config).get_api(token, endpoint, params=params)
+    # One page at a time, since a person's log can be long
+    after = to_next_token(page.get("next", None))
+    link = None
+    if after is not None:
+        link = f'/api{endpoint}?{urlencode({ **params, "__token": after })}'
+    return { "results": page.get("results", []), "next": link }
 
 
 '''
@@ -176,186 +513,613 @@ Event
 
 @nationbuilder.put("/api/pages/events/{ev}")
 async def update_event(
-        ev: int, e: HasEvent, config=Depends(to_config), token=to_token()
+        ev: int, e: HasEvent, response: Response,
+        config=Depends(to_config)
     ):
-    async def put_event():
-        url = f'/pages/events/{ev}'
-        data = json.loads(e.json())
-        await to_service(config).put_api(to_token(), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, put_event())
+    return to_update_job(config, '/pages/events', f'/pages/events/{ev}', response, e)
 
 @nationbuilder.post("/api/pages/events", status_code=_201)
 async def create_event(
-        e: HasEvent, config=Depends(to_config), token=to_token()
+        e: HasEvent, response: Response,
+        config=Depends(to_config)
     ):
     async def post_event():
         url = '/pages/events'
-        data = json.loads(e.json())
-        await to_service(config).post_api(to_token(), url, data)
+        data = e.json().encode('utf-8')
+        return await to_service(config).post_api(await to_token(config), url, data)
     # Submit request in parallel
-    pool.submit(asyncio.run, post_event())
+    return to_job(config, '/pages/events', None, response, post_event)
+
+@nationbuilder.post("/api/pages/events/bulk")
+async def bulk_events(request: Request, config=Depends(to_config)):
+    count, valid, errors = await to_bulk_items(request, HasEvent)
+    url = '/pages/events/bulk'
+    return await to_bulk_results(config, url, count, valid, errors)
 
 @nationbuilder.get("/api/pages/events")
-def list_events(config=Depends(to_config), token=to_token()):
-    return to_service(config).get_api(to_token(), '/pages/events')
+async def list_events(
+        request: Request, config=Depends(to_config)
+    ):
+    return await to_list(config, '/pages/events', request)
 
 @nationbuilder.get("/api/pages/basic_pages")
-def list_basic_pages(config=Depends(to_config), token=to_token()):
-    return to_service(config).get_api(to_token(), '/pages/basic_pages')
+async def list_basic_pages(config=Depends(to_config)):
+    return await to_service(config).get_api(await to_token(config), '/pages/basic_pages')
 
 @nationbuilder.post("/api/redirect", status_code=_201)
 async def handle_redirect(data: HasCode, config=Depends(to_config), status_code=_204):
-    oauth = to_service(config).oauth
     async def get_token(**kwargs):
-        token = oauth.get_access_token(**{
-            "decoder": json.loads,
-            "data": {
-                **kwargs,
-                "redirect_uri": config.redirect,
-                "grant_type": "authorization_code"
-            }
+        return await to_tokens(config).exchange(**{
+            **kwargs, "grant_type": "authorization_code"
         })
-        set_state('session', token=token)
     # Submit request in parallel
-    pool.submit(asyncio.run, get_token(**vars(data)))
+    to_dispatcher(config).submit(None, lambda: get_token(**vars(data)))
 
 '''
-Basic Pages, mocked
+Changes
 '''
 
-def to_basic_pages():
-    basic_pages = to_state("basic_pages")
-    if basic_pages is None: return []
-    return basic_pages.basic_pages
+# Parameters passed through to the changes feed
+CHANGE_PARAMS = ("updated_since", "resource", "limit")
 
-@nationbuilder.get("/mockup/api/v1/sites/{site}/pages/basic_pages")
-def _list_basic_pages(format: str, site: str):
-    results = [e.basic_page for e in to_basic_pages()] 
+@nationbuilder.get("/api/changes")
+async def list_changes(
+        request: Request, since: int = None, config=Depends(to_config)
+    ):
+    token = await to_token(config)
+    query = request.query_params
+    params = { k: query[k] for k in CHANGE_PARAMS if query.get(k, None) }
+    if since is not None: params['since'] = since
+    page = await to_service(config).get_api(token, '/changes', params=params)
+    # Resume from the last change seen, through this proxy
+    since = page.get("since", since)
+    link = None
+    if page.get("next", None):
+        link = f'/api/changes?{urlencode({ **params, "since": since })}'
+    return { "results": page.get("results", []), "next": link, "since": since }
+
+'''
+Stream
+'''
+
+# Seconds between reads of the shared changes feed
+STREAM_POLL = 0.25
+# Seconds between comments that keep idle connections open
+STREAM_KEEPALIVE = 15.0
+# Milliseconds browsers wait before reconnecting
+STREAM_RETRY = 1000
+
+# Finished jobs kept in the shared feed
+JOBS_KEPT = 1000
+
+def record_job(config, job):
+    # Streams on every worker read finished jobs from shared state
+    loop = asyncio.get_running_loop()
+    record = { "finished_job": { "job": job.to_dict() } }
+    def on_saved(future):
+        if future.exception() is not None: return
+        submit_write('finished_jobs', "del", future.result() - JOBS_KEPT)
+        loop.call_soon_threadsafe(to_broker(config).wake)
+    submit_write('finished_jobs', "put", NEW, record).add_done_callback(on_saved)
+
+def to_event_id(request, since):
+    # Browsers resume from the last event id they saw
+    last = request.headers.get('last-event-id', None)
+    if not last: return since
+    try:
+        return int(last)
+    except ValueError:
+        raise HTTPException(status_code=_400, detail='Invalid Last-Event-ID')
+
+async def to_event_stream(config, subscriber, since, jobs_since):
+    yield f'retry: {STREAM_RETRY}\n\n'.encode('utf-8')
+    # Tells the page whether change events will follow
+    yield to_sse("ready", { "changes": config.local })
+    idle = time.monotonic()
+    while True:
+        # Commits from every worker are read from the shared feed
+        found, more = [], False
+        if config.local:
+            found, since, more = to_changes(since, PAGE_MAX)
+            for encoded in found:
+                uid, body = to_change(encoded)
+                yield to_sse("change", body, uid)
+        # Jobs finish on whichever worker queued them
+        jobs, jobs_since, more_jobs = to_finished_jobs(jobs_since, PAGE_MAX)
+        for encoded in jobs:
+            yield to_sse("job", json.loads(encoded)["job"])
+        if found or jobs or more or more_jobs: idle = time.monotonic()
+        if more or more_jobs: continue
+        await subscriber.wait(STREAM_POLL)
+        if time.monotonic() - idle > STREAM_KEEPALIVE:
+            idle = time.monotonic()
+            yield b': keep-alive\n\n'
+
+@nationbuilder.get("/api/stream")
+async def stream_changes(
+        request: Request, since: int = None, config=Depends(to_config)
+    ):
+    since = to_event_id(request, since)
+    # New clients start from now, rather than replaying every change
+    if since is None and config.local: since = to_last_id('changes')
+    jobs_since = to_last_id('finished_jobs')
+    broker = to_broker(config)
+    subscriber = broker.subscribe()
+    async def events():
+        try:
+            async for chunk in to_event_stream(config, subscriber, since, jobs_since):
+                yield chunk
+        finally:
+            broker.unsubscribe(subscriber)
+    headers = { 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' }
+    return StreamingResponse(events(), media_type='text/event-stream', headers=headers)
+
+'''
+Rate limit, mocked
+'''
+
+buckets = {}
+
+def to_bucket(token, config):
+    if token not in buckets:
+        rate, burst = config.mock_rate_limit, config.mock_rate_burst
+        buckets[token] = Bucket(rate, burst)
+    return buckets[token]
+
+async def _rate_limit(request: Request, call_next):
+    config = to_config()
+    if not request.url.path.startswith('/mockup/api/'):
+        return await call_next(request)
+    token = request.query_params.get('access_token', None)
+    bucket = to_bucket(token, config)
+    allowed = bucket.take()
+    headers = {
+        'X-Ratelimit-Limit': str(bucket.burst),
+        'X-Ratelimit-Remaining': str(bucket.to_remaining()),
+        'X-Ratelimit-Reset': str(math.ceil(bucket.to_reset()))
+    }
+    if not allowed:
+        retry_after = str(math.ceil(bucket.to_wait()))
+        content = { 'code': 'rate_limit', 'message': 'Too Many Requests' }
+        headers = { **headers, 'Retry-After': retry_after }
+        return JSONResponse(content, status_code=_429, headers=headers)
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+# Only mockups with a rate limit pay for the middleware
+if to_config().mock_rate_limit:
+    nationbuilder.middleware("http")(_rate_limit)
+
+'''
+Metrics
+'''
+
+ROUTE_SECONDS = to_metrics().histogram(
+    'http_request_seconds', 'Request latency by route', ('method', 'route')
+)
+ROUTE_RESPONSES = to_metrics().counter(
+    'http_responses_total', 'Responses by route', ('method', 'route', 'status')
+)
+
+def to_queue_samples():
+    stats = to_dispatcher(to_config()).to_stats()
+    return [(("queued",), stats["queued"]), (("running",), stats["running"])]
+
+def to_cache_samples():
+    proxy, state = to_response_cache(to_config()).to_stats(), to_cache_stats()
+    return [
+        (("proxy", "hit"), proxy["hits"]), (("proxy", "miss"), proxy["misses"]),
+        (("state", "hit"), state["hits"]), (("state", "miss"), state["misses"])
+    ]
+
+def to_io_samples(field):
+    stats = to_io_stats()
+    return [((kind,), stats[kind][field]) for kind in ("read", "write")]
+
+to_metrics().sampled(
+    'gauge', 'write_jobs', 'Proxy writes by state', ('state',), to_queue_samples
+)
+to_metrics().sampled(
+    'counter', 'cache_lookups_total', 'Cache lookups', ('cache', 'result'),
+    to_cache_samples
+)
+def to_commit_samples(field):
+    return [((), to_commit_stats()[field])]
+
+for field, kind, name, help in [
+        ("batches", 'counter', 'state_commit_batches_total', 'Batches of mockup writes committed'),
+        ("writes", 'counter', 'state_commit_writes_total', 'Mockup writes committed in batches'),
+        ("seconds", 'counter', 'state_commit_seconds_total', 'Seconds spent committing batches'),
+        ("largest", 'gauge', 'state_commit_batch_largest', 'Most writes committed in one batch')
+    ]:
+    collect = lambda field=field: to_commit_samples(field)
+    to_metrics().sampled(kind, name, help, (), collect)
+
+to_metrics().sampled(
+    'gauge', 'stream_clients', 'Open event streams', (),
+    lambda: [((), to_broker(to_config()).to_stats()["clients"])]
+)
+for field, name, help in [
+        ("count", 'state_io_total', 'State file reads and writes'),
+        ("bytes", 'state_io_bytes_total', 'State file bytes'),
+        ("seconds", 'state_io_seconds_total', 'Seconds spent on state files')
+    ]:
+    collect = lambda field=field: to_io_samples(field)
+    to_metrics().sampled('counter', name, help, ('op',), collect)
+
+class Measured():
+    # Plain ASGI, so every request is measured without wrapping it
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            # Route templates keep the number of series bounded
+            template = getattr(scope.get('route', None), 'path', 'unmatched')
+            ROUTE_SECONDS.observe(elapsed, scope["method"], template)
+            ROUTE_RESPONSES.inc(scope["method"], template, status[0])
+
+nationbuilder.add_middleware(Measured)
+
+async def _profile(request: Request, call_next):
+    profiler = to_profiler(to_config())
+    if not profiler.is_sampled(request.headers):
+        return await call_next(request)
+    profiler.start(f'{request.method} unmatched')
+    try:
+        response = await call_next(request)
+    except Exception:
+        profiler.finish()
+        raise
+    # Profiles are grouped by route template, known once routed
+    route = request.scope.get('route', None)
+    if route is not None: profiler.active.route = f'{request.method} {route.path}'
+    # Event streams stay open, so only their handler is profiled
+    if response.media_type == 'text/event-stream':
+        profiler.finish()
+        return response
+    body = response.body_iterator
+    # Stop once the body is sent, then wait for queued writes
+    async def profiled():
+        try:
+            async for chunk in body: yield chunk
+        finally:
+            profiler.finish()
+    response.body_iterator = profiled()
+    return response
+
+if to_profiler(to_config()).is_enabled():
+    nationbuilder.middleware("http")(_profile)
+
+@nationbuilder.get("/metrics")
+async def read_metrics():
+    text = to_metrics().to_text()
+    return Response(text, media_type='text/plain; version=0.0.4')
+
+'''
+Pagination, mocked
+'''
+
+PAGE_LIMIT = 10
+PAGE_MAX = 100
+
+def to_cursor(uid):
+    return base64.urlsafe_b64encode(str(uid).encode('utf-8')).decode('utf-8')
+
+def from_cursor(cursor):
+    if cursor is None: return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except ValueError:
+        raise HTTPException(status_code=_400, detail='Invalid __token')
+
+def to_revision_etag(key, limit, cursor):
+    # The same in every worker, and across restarts
+    return f'"{key}-{to_revision(key)}-{limit}-{cursor or ""}"'
+
+def to_link(request, after, limit, params={}):
+    if after is None: return None
+    # Links are relative to the nation, like Nationbuilder's own
+    path = request.url.path.removeprefix('/mockup')
+    cursor = { '__token': to_cursor(after), 'limit': limit }
+    return f'{path}?{urlencode({ **params, **cursor })}'
+
+def to_page_body(results, link, headers={}):
+    body = b''.join([
+        b'{"results":', results, b',"next":',
+        json.dumps(link).encode('utf-8'), b'}'
+    ])
+    return Response(body, media_type='application/json', headers=headers)
+
+def to_results(key, request, limit, cursor):
+    limit = max(1, min(limit, PAGE_MAX))
+    etag = to_revision_etag(key, limit, cursor)
+    if is_fresh(request, etag):
+        return Response(status_code=_304, headers={ 'ETag': etag })
+    # Pages are served from bytes cached per collection version
+    results, after = to_page_bytes(key, from_cursor(cursor), limit)
+    link = to_link(request, after, limit)
+    return to_page_body(results, link, { 'ETag': etag })
+
+'''
+Writes, mocked
+'''
+
+async def to_commit(key, kind, uid, record=None, change=None):
+    # Batched off the event loop, and resolved once on disk
+    future = submit_write(key, kind, uid, record, change)
+    return await asyncio.wrap_future(future)
+
+'''
+Bulk writes, mocked
+'''
+
+def to_bulk(key, items, model):
+    # Updates read and write the collection under one lock
+    with to_lock(key):
+        return to_bulk_locked(key, items, model)
+
+def to_bulk_locked(key, items, model):
+    item = ITEMS[key]
+    results, records, creates = [], {}, []
+    for e in items:
+        try:
+            fields = dict(e[item])
+            uid = fields.pop("id", None)
+            if uid is None:
+                record = { item: fields }
+            else:
+                # Later updates in one batch build on earlier ones
+                found = records.get(uid, None) or to_record(key, uid)
+                if found is None:
+                    results.append({ "status": _404, "error": "Not Found" })
+                    continue
+                record = found if isinstance(found, dict) else found.dict()
+                record[item].update(fields)
+            model.parse_obj(record)
+        except (KeyError, TypeError) as error:
+            results.append({ "status": _422, "error": f'Missing {error}' })
+            continue
+        except ValidationError as error:
+            results.append({ "status": _422, "error": error.errors() })
+            continue
+        if uid is None: creates.append(record)
+        else: records[uid] = record
+        status = _201 if uid is None else 200
+        results.append({ "status": status, item: record[item] })
+    # One id allocation and one state commit for the whole batch
+    for uid, record in zip(to_next_ids(key, len(creates)), creates):
+        record[item]["id"] = uid
+        records[uid] = record
+    updated_at = put_records(key, list(records.items()))
+    # Results show records as committed, stamp included
+    for result in results:
+        if item in result: result[item]["updated_at"] = updated_at
     return { "results": results }
 
+'''
+Basic Pages, mocked
+'''
+
+@nationbuilder.get("/mockup/api/v1/sites/{site}/pages/basic_pages")
+def _list_basic_pages(
+        format: str, site: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    return to_results("basic_pages", request, limit, cursor)
+
 @nationbuilder.post("/mockup/api/v1/sites/{site}/pages/basic_pages", status_code=_201)
 async def _create_basic_page(request: Request):
     basic_page = json.loads((await request.body()).decode('utf-8'))
-    basic_pages = [e.dict() for e in to_basic_pages()]
-    basic_page["basic_page"]["id"] = len(basic_pages)
-    set_state('basic_pages', basic_pages=[basic_page, *basic_pages])
+    await to_commit('basic_pages', "put", NEW, basic_page)
 
 '''
 Contact, mocked
 '''
 
-def to_contacts():
-    contacts = to_state("contacts")
-    if contacts is None: return []
-    return contacts.contacts
-
 @nationbuilder.post("/mockup/api/v1/people/{who}/contacts", status_code=_201)
 async def _create_contact(who: int, request: Request):
     contact = json.loads((await request.body()).decode('utf-8'))
-    contacts = [e.dict() for e in to_contacts()]
-    set_state('contacts', contacts=[contact, *contacts])
+    contact["contact"]["person_id"] = who
+    # Appended to the log, and indexed by person
+    await to_commit('contacts', "put", NEW, contact)
+
+@nationbuilder.get("/mockup/api/v1/people/{who}/contacts")
+def _list_contacts(
+        who: int, format: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    limit = max(1, min(limit, PAGE_MAX))
+    filters = { "person_id": who }
+    found, after = to_matches("contacts", filters, from_cursor(cursor), limit)
+    results = b'[' + b','.join(found) + b']'
+    return to_page_body(results, to_link(request, after, limit))
 
 '''
 Person, mocked
 '''
 
-def to_persons():
-    persons = to_state("persons")
-    if persons is None: return []
-    return persons.persons
-
-def is_who(e, who):
-    return e["person"]["id"] == who
+# Person fields accepted by people/search
+SEARCH_FIELDS = ("last_name", "first_name", "state", "party", "employer")
 
-def update_who(e, who, person):
-    if is_who(e, who):
-        e["person"].update(person["person"])
-        return True
-    return False
+def to_search(request):
+    params = request.query_params
+    return { k: params[k] for k in SEARCH_FIELDS if params.get(k, None) }
 
 @nationbuilder.delete("/mockup/api/v1/people/{who}", status_code=_204)
 async def _delete_person(who: int, request: Request):
-    persons = [e.dict() for e in to_persons()]
-    persons = [e for e in persons if not is_who(e, who)]
-    set_state('persons', persons=persons)
+    # Found under the lock, along with the delete
+    if await to_commit('persons', "del", who, change=lambda found: found) is None:
+        raise HTTPException(status_code=_404)
 
 @nationbuilder.put("/mockup/api/v1/people/{who}", status_code=_201)
 async def _update_person(who: int, request: Request):
     person = json.loads((await request.body()).decode('utf-8'))
     person["person"].pop("id", None)
-    persons = [e.dict() for e in to_persons()]
-    next(e for e in persons if update_who(e, who, person))
-    set_state('persons', persons=persons)
+    def change(found):
+        found["person"].update(person["person"])
+        return found
+    # Applied under the lock, so other workers' writes are seen
+    if await to_commit('persons', "put", who, change=change) is None:
+        raise HTTPException(status_code=_404)
 
 @nationbuilder.post("/mockup/api/v1/people", status_code=_201)
 async def _create_person(request: Request):
     person = json.loads((await request.body()).decode('utf-8'))
-    persons = [e.dict() for e in to_persons()]
-    person["person"]["id"] = len(persons)
-    set_state('persons', persons=[person, *persons])
+    await to_commit('persons', "put", NEW, person)
+
+@nationbuilder.post("/mockup/api/v1/people/bulk")
+async def _bulk_persons(request: Request):
+    persons = json.loads((await request.body()).decode('utf-8'))
+    return await asyncio.wrap_future(submit_call(lambda: to_bulk("persons", persons, HasPerson)))
 
 @nationbuilder.get("/mockup/api/v1/people")
-def _list_persons(format: str):
-    results = [e.person for e in to_persons()] 
-    return { "results": results }
+def _list_persons(
+        format: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    return to_results("persons", request, limit, cursor)
+
+@nationbuilder.get("/mockup/api/v1/people/match")
+def _match_person(format: str, email: str):
+    found, _ = to_matches("persons", { "email": email }, None, 2)
+    if len(found) == 1:
+        body = b'{"person":' + found[0] + b'}'
+        return Response(body, media_type='application/json')
+    code = 'no_matches' if not found else 'multiple_matches'
+    message = 'No people matched the given criteria.'
+    if found: message = 'Multiple people matched the given criteria.'
+    content = { 'code': code, 'message': message }
+    return JSONResponse(content, status_code=_400)
+
+@nationbuilder.get("/mockup/api/v1/people/search")
+def _search_persons(
+        format: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    filters = to_search(request)
+    if not filters:
+        detail = f'Search by one of {", ".join(SEARCH_FIELDS)}'
+        raise HTTPException(status_code=_400, detail=detail)
+    limit = max(1, min(limit, PAGE_MAX))
+    found, after = to_matches("persons", filters, from_cursor(cursor), limit)
+    results = b'[' + b','.join(found) + b']'
+    return to_page_body(results, to_link(request, after, limit, filters))
 
 '''
 Survey, mocked
 '''
 
-def to_surveys():
-    surveys = to_state("surveys")
-    if surveys is None: return []
-    return surveys.surveys
-
 @nationbuilder.post("/mockup/api/v1/sites/{site}/pages/surveys", status_code=_201)
 async def _create_survey(request: Request):
     survey = json.loads((await request.body()).decode('utf-8'))
-    surveys = [e.dict() for e in to_surveys()]
-    survey["survey"]["id"] = len(surveys)
-    set_state('surveys', surveys=[survey, *surveys])
+    await to_commit('surveys', "put", NEW, survey)
 
 @nationbuilder.get("/mockup/api/v1/sites/{site}/pages/surveys")
-def _list_surveys(format: str):
-    results = [e.survey for e in to_surveys()] 
-    return { "results": results }
+def _list_surveys(
+        format: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    return to_results("surveys", request, limit, cursor)
 
 
 '''
 Event, mocked
 '''
 
-def to_events():
-    events = to_state("events")
-    if events is None: return []
-    return events.events
-
-def update_ev(e, ev, event):
-    if e["event"]["id"] == ev:
-        e["event"].update(event["event"])
-        return True
-    return False
-
 @nationbuilder.put("/mockup/api/v1/pages/events/{ev}", status_code=_201)
 async def _update_event(ev: int, request: Request):
     event = json.loads((await request.body()).decode('utf-8'))
     event["event"].pop("id", None)
-    events = [e.dict() for e in to_events()]
-    next(e for e in events if update_ev(e, ev, event))
-    set_state('events', events=events)
+    def change(found):
+        found["event"].update(event["event"])
+        return found
+    # Applied under the lock, so other workers' writes are seen
+    if await to_commit('events', "put", ev, change=change) is None:
+        raise HTTPException(status_code=_404)
 
 @nationbuilder.post("/mockup/api/v1/pages/events", status_code=_201)
 async def _create_event(request: Request):
     event = json.loads((await request.body()).decode('utf-8'))
-    events = [e.dict() for e in to_events()]
-    event["event"]["id"] = len(events)
-    set_state('events', events=[event, *events])
+    await to_commit('events', "put", NEW, event)
+
+@nationbuilder.post("/mockup/api/v1/pages/events/bulk")
+async def _bulk_events(request: Request):
+    events = json.loads((await request.body()).decode('utf-8'))
+    return await asyncio.wrap_future(submit_call(lambda: to_bulk("events", events, HasEvent)))
 
 @nationbuilder.get("/mockup/api/v1/pages/events")
-def _list_events(format: str):
-    results = [e.event for e in to_events()] 
-    return { "results": results }
+def _list_events(
+        format: str, request: Request,
+        limit: int = PAGE_LIMIT,
+        cursor: str = Query(None, alias='__token')
+    ):
+    return to_results("events", request, limit, cursor)
+
+'''
+Changes, mocked
+'''
+
+def to_updated_since(updated_since):
+    if updated_since is None: return None
+    try:
+        return datetime.fromisoformat(updated_since)
+    except ValueError:
+        raise HTTPException(status_code=_400, detail='Invalid updated_since')
+
+def to_change(encoded):
+    change = json.loads(encoded)
+    resource = change["resource"]
+    # Tombstones, and records deleted since, have no body
+    record = None
+    if change["kind"] != "del":
+        record = to_record_bytes(resource, change["uid"])
+    item = ITEMS[resource].encode('utf-8')
+    body = b'null' if record is None else record
+    return change["id"], b''.join([encoded[:-1], b',"', item, b'":', body, b'}'])
+
+@nationbuilder.get("/mockup/api/v1/changes")
+def _list_changes(
+        format: str, request: Request,
+        limit: int = PAGE_LIMIT, since: int = None,
+        updated_since: str = None, resource: str = None
+    ):
+    limit = max(1, min(limit, PAGE_MAX))
+    if resource is not None and resource not in TRACKED:
+        detail = f'Resource is one of {", ".join(TRACKED)}'
+        raise HTTPException(status_code=_400, detail=detail)
+    at = to_updated_since(updated_since)
+    found, last, more = to_changes(since, limit, at, resource)
+    results = b'[' + b','.join(to_change(e)[1] for e in found) + b']'
+    link = None
+    if more:
+        params = {} if resource is None else { "resource": resource }
+        cursor = { "since": last, "limit": limit }
+        path = request.url.path.removeprefix('/mockup')
+        link = f'{path}?{urlencode({ **params, **cursor })}'
+    body = b''.join([
+        b'{"results":', results, b',"next":', json.dumps(link).encode('utf-8'),
+        b',"since":', json.dumps(last).encode('utf-8'), b'}'
+    ])
+    return Response(body, media_type='application/json')
 
 # "Ask a nation's administrator for access"
 @nationbuilder.get("/mockup/oauth/authorize", status_code=_204)
@@ -365,10 +1129,29 @@ def _authorize_url(redirect_uri):
 
 # "Exchange the code for an access token"
 @nationbuilder.post("/mockup/oauth/token")
-async def _get_access_token(request: Request):
+async def _get_access_token(request: Request, config=Depends(to_config)):
     qs = parse_qs((await request.body()).decode('utf-8'))
-    access_token = '-'.join(['token', 'for'] + qs['code'])
-    return { 'access_token': access_token }
+    if 'refresh_token' in qs:
+        refresh_token = qs['refresh_token'][0]
+    elif 'code' in qs:
+        refresh_token = '-'.join(['refresh', 'for'] + qs['code'])
+    else:
+        raise HTTPException(status_code=_400)
+    # Each exchange issues a fresh access token
+    code = refresh_token.removeprefix('refresh-for-')
+    access_token = '-'.join(['token', 'for', code, uuid4().hex[:8]])
+    return {
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_in': config.mock_token_ttl,
+        'token_type': 'bearer'
+    }
+
+# Report failed upstream reads instead of empty results
+@nationbuilder.exception_handler(UpstreamError)
+async def upstream_exception_handler(request: Request, exc: UpstreamError):
+    content = {'status_code': exc.status_code, 'data': exc.detail}
+    return JSONResponse(content=content, status_code=_502)
 
 # Handle common FastAPI exceptions
 @nationbuilder.exception_handler(RequestValidationError)
@@ -3,3 +3,5 @@ from .survey import HasSurvey
 from .person import HasPerson
 from .contact import HasContact
 from .basic_page import HasBasicPage
+from .change import HasChange
+from .job import HasFinishedJob
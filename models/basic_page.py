@@ -6,6 +6,7 @@ class BasicPage(BaseModel):
     id: Optional[int]
     content: str
     status: str
+    updated_at: Optional[str]
 
 class HasBasicPage(BaseModel):
     basic_page: BasicPage
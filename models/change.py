@@ -0,0 +1,11 @@
+from pydantic import BaseModel
+
+class Change(BaseModel):
+    id: int
+    resource: str
+    uid: int
+    kind: str
+    updated_at: str
+
+class HasChange(BaseModel):
+    change: Change
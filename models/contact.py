@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional
 
 class Contact(BaseModel):
     type_id: int
@@ -7,6 +8,8 @@ class Contact(BaseModel):
     status: str
     method: str
     note: str
+    id: Optional[int]
+    updated_at: Optional[str]
 
 class HasContact(BaseModel):
     contact: Contact
@@ -41,6 +41,7 @@ class Event(BaseModel):
     show_guests: bool
     capacity: int
     venue: Venue
+    updated_at: Optional[str]
 
 class HasEvent(BaseModel):
     event: Event
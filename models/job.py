@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+from typing import Any, Dict
+
+class FinishedJob(BaseModel):
+    id: int
+    job: Dict[str, Any]
+
+class HasFinishedJob(BaseModel):
+    finished_job: FinishedJob
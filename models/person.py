@@ -15,6 +15,7 @@ class Person(BaseModel):
     employer: str
     party: str
     registered_address: RegisteredAddress
+    updated_at: Optional[str]
 
 class HasPerson(BaseModel):
     person: Person
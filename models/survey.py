@@ -21,6 +21,7 @@ class Survey(BaseModel):
     tags: List[str]
     id: Optional[int]
     questions: List[Question]
+    updated_at: Optional[str]
 
 
 class HasSurvey(BaseModel):
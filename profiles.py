@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+import pstats
+import io
+
+# Leaf frames of threads that are waiting rather than working
+IDLE = {'threading:wait', 'selectors:select', 'queue:get', 'threading:_wait_for_tstate_lock'}
+
+def to_help(label):
+    if label == 'dir': return 'directory of request profiles'
+    if label == 'top': return 'number of functions to report'
+    if label == 'route': return 'only report routes whose folder contains this'
+    if label == 'sort': return 'order cProfile functions by this key'
+    return label
+
+parser = ArgumentParser(
+                    prog='Nationbuilder Profiles',
+                    description='Report hot functions in sampled request profiles')
+parser.add_argument('directory', nargs='?', default='profiles', help=to_help('dir'))
+parser.add_argument('--top', type=int, default=20, help=to_help('top'))
+parser.add_argument('--route', help=to_help('route'))
+parser.add_argument('--sort', default='tottime', choices=['tottime', 'cumulative', 'ncalls'], help=to_help('sort'))
+
+def to_files(directory, route, suffix):
+    for path in sorted(Path(directory).glob(f'*/*{suffix}')):
+        if route and route not in path.parent.name: continue
+        yield path
+
+def to_profile_report(files, top, sort):
+    files = [str(path) for path in files]
+    if not files: return 'No cProfile output found\n'
+    out = io.StringIO()
+    stats = pstats.Stats(files[0], stream=out)
+    for path in files[1:]: stats.add(path)
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return f'{len(files)} profiles, event loop thread\n{out.getvalue()}'
+
+def to_sample_report(files, top):
+    leaves, inclusive, total = Counter(), Counter(), 0
+    for path in files:
+        for line in path.read_text().splitlines():
+            stack, _, count = line.rpartition(' ')
+            frames, count = stack.split(';'), int(count)
+            if frames[-1] in IDLE: continue
+            total += count
+            # Self time goes to the innermost frame, inclusive time to all
+            leaves[frames[-1]] += count
+            for frame in set(frames): inclusive[frame] += count
+    if not total: return 'No stack samples found\n'
+    lines = [f'{total} busy stack samples, all threads', '', 'self%   total%  function']
+    for frame, count in leaves.most_common(top):
+        share = 100 * count / total
+        lines.append(f'{share:6.2f}  {100 * inclusive[frame] / total:6.2f}  {frame}')
+    return '\n'.join(lines) + '\n'
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    profiles = to_files(args.directory, args.route, '.prof')
+    samples = to_files(args.directory, args.route, '.collapsed')
+    print(to_profile_report(profiles, args.top, args.sort))
+    print(to_sample_report(samples, args.top))
@@ -1,2 +1,24 @@
 from .state import to_state
 from .state import set_state
+from .state import set_backend
+from .state import to_cache_stats
+from .state import to_record
+from .state import ITEMS
+from .state import put_records
+from .state import to_next_ids
+from .state import to_revision
+from .state import to_seq
+from .state import to_page_bytes
+from .state import to_matches
+from .state import INDEXES
+from .state import to_io_stats
+from .state import to_lock
+from .state import to_changes
+from .state import to_finished_jobs
+from .state import to_last_id
+from .state import to_record_bytes
+from .state import TRACKED
+from .state import submit_write
+from .state import submit_call
+from .state import to_commit_stats
+from .state import NEW
@@ -0,0 +1,115 @@
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from .lock import FileLock
+import json
+import time
+import os
+
+class FileBackend():
+    def __init__(self, root, items):
+        # Shared with other worker processes through lock files
+        self.locks = {
+            k: FileLock(root.joinpath(f'{k}.lock')) for k in items.keys()
+        }
+        # Operations, bytes and seconds of file reads and writes
+        self.io = { "read": [0, 0, 0.0], "write": [0, 0, 0.0] }
+        self.io_lock = Lock()
+        self.items = items
+        self.root = root
+
+    def to_file(self, key):
+        return self.root.joinpath(f'{key}.json')
+
+    def to_lock(self, key):
+        return self.locks[key]
+
+    def to_paths(self, key):
+        return [self.to_file(key)]
+
+    def to_stamp(self, key):
+        stamp = []
+        for path in self.to_paths(key):
+            try:
+                stat = os.stat(path)
+                # Replaced files get new inodes, even within one mtime tick
+                stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def measure(self, kind, size, started):
+        with self.io_lock:
+            stats = self.io[kind]
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += time.perf_counter() - started
+
+    def to_io_stats(self):
+        with self.io_lock:
+            return {
+                kind: { "count": n, "bytes": size, "seconds": seconds }
+                for kind, (n, size, seconds) in self.io.items()
+            }
+
+    def to_uid(self, key, record):
+        item = self.items[key]
+        if item is None: return None
+        return record[item].get("id", None)
+
+    def read(self, key):
+        filename = self.to_file(key)
+        if not os.path.exists(filename):
+            return None
+        started = time.perf_counter()
+        with open(filename, 'r') as f:
+            text = f.read()
+        self.measure("read", len(text), started)
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            if self.items[key] is None: return None
+            return { key: [] }
+
+    def load(self, key):
+        with self.to_lock(key):
+            return self.read(key)
+
+    def write_temp(self, text):
+        started = time.perf_counter()
+        with NamedTemporaryFile('w', dir=self.root, delete=False) as f:
+            f.write(text)
+            # Renamed into place only once it is on disk
+            f.flush()
+            os.fsync(f.fileno())
+        self.measure("write", len(text), started)
+        return f.name
+
+    def save(self, key, data):
+        with self.to_lock(key):
+            # Readers see the old file or the new one, never part of one
+            tmp = self.write_temp(json.dumps(data))
+            os.replace(tmp, self.to_file(key))
+
+    def to_seq(self, key):
+        # Whole files have no sequence of writes
+        return None
+
+    def to_ops_since(self, key, before, after, seq=None):
+        # Whole files are rewritten, so there is nothing to catch up on
+        return None
+
+    def commit(self, key, ops):
+        with self.to_lock(key):
+            data = self.load(key) or { key: [] }
+            for kind, uid, record in ops:
+                data[key] = self.apply(key, data[key], kind, uid, record)
+            self.save(key, data)
+
+    def apply(self, key, records, kind, uid, record):
+        if kind == "del":
+            return [e for e in records if self.to_uid(key, e) != uid]
+        for i, e in enumerate(records):
+            if uid is not None and self.to_uid(key, e) == uid:
+                records[i] = record
+                return records
+        return [record, *records]
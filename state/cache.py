@@ -0,0 +1,312 @@
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+from itertools import count
+
+# Serialized pages kept per collection version
+PAGE_CACHE_LIMIT = 256
+
+class Entry():
+    def __init__(self, key, stamp, model, items, fields=None, seq=None):
+        self.key = key
+        self.stamp = stamp
+        # The last journal seq applied, where backends keep one
+        self.seq = seq
+        self.model = model
+        self.order = None
+        self.records = {}
+        self.encoded = {}
+        self.pages = {}
+        self.added = count()
+        # Secondary indexes map each term to a sorted list of uids
+        self.fields = fields or {}
+        self.indexes = { name: {} for name in self.fields }
+        # Missing files are cached until the stamp changes
+        self.missing = model is None
+        if items is None or model is None: return
+        for item in reversed(getattr(model, key)):
+            self.records[self.to_slot(items, item)] = item
+        self.build()
+
+    def to_slot(self, items, item):
+        # Contacts logged before ids were assigned have none
+        uid = getattr(getattr(item, items), "id", None)
+        if uid is None: return ('add', next(self.added))
+        return uid
+
+    def touch(self, stamp, seq):
+        self.missing = False
+        self.seq = seq
+        self.stamp = stamp
+        self.model = None
+        self.pages = {}
+
+    def to_terms(self, item):
+        for name, path in self.fields.items():
+            value = item
+            for field in path:
+                value = getattr(value, field, None)
+            if value is not None: yield name, to_term(value)
+
+    def build(self):
+        for uid, item in self.records.items():
+            if not isinstance(uid, int): continue
+            for name, term in self.to_terms(item):
+                self.indexes[name].setdefault(term, []).append(uid)
+        # Sorting once is far cheaper than inserting in order
+        for index in self.indexes.values():
+            for uids in index.values(): uids.sort()
+
+    def index(self, uid, item):
+        if not isinstance(uid, int): return
+        for name, term in self.to_terms(item):
+            insort(self.indexes[name].setdefault(term, []), uid)
+
+    def unindex(self, uid):
+        item = self.records.get(uid, None)
+        if item is None or not isinstance(uid, int): return
+        for name, term in self.to_terms(item):
+            uids = self.indexes[name].get(term, [])
+            i = bisect_left(uids, uid)
+            if i < len(uids) and uids[i] == uid: del uids[i]
+            if not uids: self.indexes[name].pop(term, None)
+
+    def to_matches(self, filters, before, limit):
+        postings = [
+            self.indexes[name].get(to_term(value), [])
+            for name, value in filters.items()
+        ]
+        # Walk the shortest list, newest first, probing the others
+        postings.sort(key=len)
+        first, rest = postings[0], postings[1:]
+        end = len(first) if before is None else bisect_left(first, before)
+        uids = []
+        for i in range(end - 1, -1, -1):
+            uid = first[i]
+            if not all(has_uid(other, uid) for other in rest): continue
+            if len(uids) == limit: return uids, uids[-1]
+            uids.append(uid)
+        return uids, None
+
+    def to_encoded(self, uid, items):
+        # Each record is serialized once, until it is written again
+        if uid not in self.encoded:
+            item = getattr(self.records[uid], items)
+            text = item.json(separators=(',', ':'))
+            self.encoded[uid] = text.encode('utf-8')
+        return self.encoded[uid]
+
+    def reorder(self, uid, kept):
+        # Ids stay sorted across writes, rather than sorted again on read
+        if self.order is None or not isinstance(uid, int): return
+        has = has_uid(self.order, uid)
+        if kept and not has: insort(self.order, uid)
+        if not kept and has: self.order.pop(bisect_left(self.order, uid))
+
+    def to_order(self):
+        if self.order is None:
+            uids = [k for k in self.records if isinstance(k, int)]
+            self.order = sorted(uids)
+        return self.order
+
+    def to_model(self, model_type):
+        if self.missing: return None
+        if self.model is None:
+            records = list(reversed(self.records.values()))
+            self.model = model_type.construct(**{ self.key: records })
+        return self.model
+
+class StateCache():
+    def __init__(self, types, items, indexes=None):
+        self.indexes = indexes or {}
+        self.types = types
+        self.items = items
+        self.entries = {}
+        self.lock = Lock()
+        self.misses = 0
+        self.hits = 0
+
+    def to_item_type(self, key):
+        return self.types[key].__fields__[key].type_
+
+    def to_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries)
+        }
+
+    def get(self, key, backend):
+        # Only whole collection reads build the model
+        entry = self.refresh(key, backend)
+        with self.lock:
+            return entry.to_model(self.types[key])
+
+    def refresh(self, key, backend):
+        stamp = backend.to_stamp(key)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry.stamp == stamp:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # Writers hold the same lock while updating entries in place
+        with backend.to_lock(key):
+            stamp = backend.to_stamp(key)
+            entry = self.catch_up(key, backend, stamp)
+            if entry is not None: return entry
+            data = backend.load(key)
+            model = None if data is None else self.types[key](**data)
+            return self.set(key, stamp, model, backend.to_seq(key))
+
+    def catch_up(self, key, backend, stamp):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return None
+            before, seq = entry.stamp, entry.seq
+        # Replay only what other workers wrote since the last read
+        if before != stamp:
+            found = backend.to_ops_since(key, before, stamp, seq)
+            if found is None: return None
+            ops, seq = found
+            self.commit(key, before, stamp, ops, seq)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or entry.stamp != stamp: return None
+            return entry
+
+    def get_record(self, key, uid, backend):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return None
+            return entry.records.get(uid, None)
+
+    def get_page_bytes(self, key, backend, before, limit):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return b'[]', None
+            cached = entry.pages.get((before, limit), None)
+            if cached is not None: return cached
+            order = entry.to_order()
+            end = len(order) if before is None else bisect_left(order, before)
+            start = max(0, end - limit)
+            items = self.items[key]
+            uids = reversed(order[start:end])
+            body = b','.join(entry.to_encoded(uid, items) for uid in uids)
+            page = (b'[' + body + b']', order[start] if start > 0 else None)
+            if len(entry.pages) >= PAGE_CACHE_LIMIT: entry.pages.clear()
+            entry.pages[(before, limit)] = page
+            return page
+
+    def get_since(self, key, backend, after, limit, at=None, match=None):
+        # Oldest first, for feeds that resume from the last id they saw
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return [], after, False
+            items = self.items[key]
+            order = entry.to_order()
+            start = 0 if after is None else bisect_right(order, after)
+            if at is not None:
+                # Stamps grow with ids, so they can be bisected too
+                stamp = lambda uid: getattr(entry.records[uid], items).updated_at
+                start = max(start, bisect_left(order, at, key=stamp))
+            found, last = [], after
+            for i in range(start, len(order)):
+                if len(found) == limit: return found, last, True
+                uid = order[i]
+                last = uid
+                if match is not None and not match(entry.records[uid]): continue
+                found.append(entry.to_encoded(uid, items))
+            return found, last, False
+
+    def get_last(self, key, backend):
+        # The newest id, where new readers of a feed start
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return None
+            order = entry.to_order()
+            return order[-1] if order else None
+
+    def get_encoded(self, key, uid, backend):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or uid not in entry.records: return None
+            return entry.to_encoded(uid, self.items[key])
+
+    def get_match_ids(self, key, backend, filters):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return []
+            uids, _ = entry.to_matches(filters, None, None)
+            return uids
+
+    def get_matches(self, key, backend, filters, before, limit):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return [], None
+            uids, after = entry.to_matches(filters, before, limit)
+            items = self.items[key]
+            return [entry.to_encoded(uid, items) for uid in uids], after
+
+    def get_revision(self, key, backend):
+        # Read from the files, so every worker and restart agrees on it
+        entry = self.refresh(key, backend)
+        with self.lock:
+            if entry.seq is not None: return str(entry.seq)
+            # Whole files have no seq, but are restamped on every save
+            parts = [n for part in entry.stamp if part for n in part]
+            return '.'.join(format(n, 'x') for n in parts)
+
+    def get_uids(self, key, backend):
+        self.refresh(key, backend)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return []
+            return list(entry.to_order())
+
+    def set(self, key, stamp, model, seq=None):
+        with self.lock:
+            items = self.items[key]
+            fields = self.indexes.get(key, None)
+            entry = Entry(key, stamp, model, items, fields, seq)
+            self.entries[key] = entry
+            return entry
+
+    def save(self, key, stamp, data, seq=None):
+        self.set(key, stamp, self.types[key](**data), seq)
+
+    def commit(self, key, before, after, ops, seq=None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None: return
+            # Drop entries that missed a write from elsewhere
+            if entry.stamp != before:
+                self.entries.pop(key)
+                return
+            item_type = self.to_item_type(key)
+            for kind, uid, record in ops:
+                entry.encoded.pop(uid, None)
+                entry.unindex(uid)
+                entry.reorder(uid, kind != "del")
+                if kind == "del":
+                    entry.records.pop(uid, None)
+                    continue
+                if uid is None:
+                    uid = ('add', next(entry.added))
+                entry.records[uid] = item_type(**record)
+                entry.index(uid, entry.records[uid])
+            entry.touch(after, seq)
+
+def to_term(value):
+    # Lookups ignore case, as Nationbuilder's do
+    return str(value).casefold()
+
+def has_uid(uids, uid):
+    i = bisect_left(uids, uid)
+    return i < len(uids) and uids[i] == uid
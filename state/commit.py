@@ -0,0 +1,95 @@
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from collections import deque
+import time
+
+# Seconds a batch stays open for more writes after its first
+COMMIT_WINDOW = 0.002
+# Most writes applied in one batch
+COMMIT_LIMIT = 1000
+# Stands in for an id the committer allocates
+NEW = object()
+
+class Write():
+    def __init__(self, key, kind, uid, record=None, change=None, call=None):
+        self.key = key
+        self.kind = kind
+        self.uid = uid
+        self.record = record
+        self.change = change
+        self.call = call
+        self.future = Future()
+
+class Committer():
+    def __init__(self, commit, window=COMMIT_WINDOW, limit=COMMIT_LIMIT):
+        self.ready = Condition()
+        self.queue = deque()
+        self.commit = commit
+        self.window = window
+        self.limit = limit
+        self.thread = None
+        # Batches, writes, seconds committing, and the largest batch
+        self.stats = [0, 0, 0.0, 0]
+        self.stats_lock = Lock()
+
+    def to_stats(self):
+        with self.stats_lock:
+            batches, writes, seconds, largest = self.stats
+        return {
+            "batches": batches, "writes": writes,
+            "seconds": seconds, "largest": largest
+        }
+
+    def submit(self, write):
+        with self.ready:
+            # Started lazily, so each worker process has its own
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.queue.append(write)
+            self.ready.notify()
+        return write.future
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue: self.ready.wait()
+            # Writes arriving meanwhile join the same batch
+            time.sleep(self.window)
+            with self.ready:
+                count = min(len(self.queue), self.limit)
+                batch = [self.queue.popleft() for _ in range(count)]
+            started = time.perf_counter()
+            self.commit_batch(batch)
+            with self.stats_lock:
+                self.stats[0] += 1
+                self.stats[1] += len(batch)
+                self.stats[2] += time.perf_counter() - started
+                self.stats[3] = max(self.stats[3], len(batch))
+
+    def commit_batch(self, batch):
+        groups = {}
+        for write in batch:
+            if write.call is None:
+                groups.setdefault(write.key, []).append(write)
+                continue
+            # Calls see every write queued before them
+            self.commit_groups(groups)
+            groups = {}
+            resolve(write.future, write.call)
+        self.commit_groups(groups)
+
+    def commit_groups(self, groups):
+        # One read-apply-write for each collection in the batch
+        for key, writes in groups.items():
+            try:
+                self.commit(key, writes)
+            except Exception as e:
+                for write in writes:
+                    if not write.future.done(): write.future.set_exception(e)
+
+def resolve(future, call):
+    try:
+        future.set_result(call())
+    except Exception as e:
+        future.set_exception(e)
@@ -0,0 +1,238 @@
+from .backend import FileBackend
+from threading import Thread
+import json
+import re
+import time
+import os
+
+# Compact once the journal grows past this many bytes
+JOURNAL_LIMIT = 1 << 20
+# Bytes read from the end of a file to find its last seq
+TAIL_BYTES = 1 << 16
+SNAPSHOT_SEQ = re.compile(rb'"seq": (\d+)\}\s*$')
+
+class JournalBackend(FileBackend):
+    def __init__(self, root, items, limit=JOURNAL_LIMIT):
+        super().__init__(root, items)
+        self.epochs = { k: 0 for k in items.keys() }
+        self.compacting = set()
+        self.limit = limit
+        self.seqs = {}
+        self.seen = {}
+
+    def to_journal(self, key, suffix=''):
+        return self.root.joinpath(f'{key}.journal{suffix}')
+
+    def to_paths(self, key):
+        journals = [self.to_journal(key, s) for s in ('.old', '')]
+        return [self.to_file(key), *journals]
+
+    def to_records(self, key, snapshot):
+        records = {}
+        for i, e in enumerate(reversed(snapshot.get(key, []))):
+            uid = self.to_uid(key, e)
+            records[('snap', i) if uid is None else uid] = e
+        return records
+
+    def to_data(self, key, records):
+        return { key: list(reversed(records.values())) }
+
+    def apply(self, records, op):
+        uid = op["id"]
+        if op["op"] == "del":
+            records.pop(uid, None)
+        else:
+            records[('seq', op["seq"]) if uid is None else uid] = op["record"]
+
+    def replay(self, records, filename, seq):
+        if not os.path.exists(filename): return seq
+        started, size = time.perf_counter(), 0
+        with open(filename, 'r') as f:
+            for line in f:
+                size += len(line)
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn final line from an interrupted append
+                    break
+                if op["seq"] <= seq: continue
+                self.apply(records, op)
+                seq = op["seq"]
+        self.measure("read", size, started)
+        return seq
+
+    def replay_all(self, key, suffixes=('.old', '')):
+        snapshot = self.read(key)
+        journals = [self.to_journal(key, s) for s in suffixes]
+        if snapshot is None and not any(map(os.path.exists, journals)):
+            return None, 0
+        snapshot = snapshot or {}
+        seq = snapshot.pop("seq", 0)
+        records = self.to_records(key, snapshot)
+        for journal in journals:
+            seq = self.replay(records, journal, seq)
+        return records, seq
+
+    def to_seq(self, key):
+        if self.items[key] is None: return None
+        # Other workers may have written since this one last did
+        stamp = self.to_stamp(key)
+        if self.seen.get(key, None) != stamp:
+            self.seqs[key] = self.to_disk_seq(key)
+            self.seen[key] = stamp
+        return self.seqs[key]
+
+    def to_disk_seq(self, key):
+        seqs = [self.to_snapshot_seq(key)]
+        for suffix in ('.old', ''):
+            seq = self.to_tail_seq(self.to_journal(key, suffix))
+            if seq is None:
+                _, seq = self.replay_all(key)
+                return seq
+            seqs.append(seq)
+        return max(seqs)
+
+    def to_snapshot_seq(self, key):
+        tail = self.to_tail(self.to_file(key))
+        match = SNAPSHOT_SEQ.search(tail)
+        return 0 if match is None else int(match.group(1))
+
+    def to_tail_seq(self, filename):
+        tail = self.to_tail(filename)
+        lines = tail.split(b'\n')
+        # The first line may be cut off, unless the tail is the whole file
+        whole = len(tail) < TAIL_BYTES
+        for i, line in reversed(list(enumerate(lines))):
+            if not line.strip() or (i == 0 and not whole): continue
+            try:
+                return json.loads(line)["seq"]
+            except json.JSONDecodeError:
+                continue
+        return 0 if whole else None
+
+    def to_tail(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - TAIL_BYTES))
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def to_ops_since(self, key, before, after, seq=None):
+        if self.items[key] is None: return None
+        if before is None: return None
+        journal = before[2]
+        # Appends to the same journal are read from where the entry left off
+        if before[:2] == after[:2]:
+            if after[2] is None: return None
+            if journal is not None and journal[0] != after[2][0]: return None
+            offset = 0 if journal is None else journal[2]
+            if after[2][2] < offset: return None
+            return self.to_ops(self.to_journal(key), offset, after[2][2], seq)
+        # Rotated or compacted since, so only unseen seqs can be replayed
+        if seq is None or self.to_snapshot_seq(key) > seq: return None
+        ops = []
+        for suffix, stamp in (('.old', after[1]), ('', after[2])):
+            if stamp is None: continue
+            moved = journal is not None and journal[0] == stamp[0]
+            offset = journal[2] if moved else 0
+            found, seq = self.to_ops(self.to_journal(key, suffix), offset, stamp[2], seq)
+            ops += found
+        return ops, seq
+
+    def to_ops(self, filename, offset, end, seq):
+        started = time.perf_counter()
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            text = f.read(end - offset)
+        self.measure("read", len(text), started)
+        ops = []
+        for line in text.splitlines():
+            try:
+                op = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn final line from an interrupted append
+                break
+            if seq is not None and op["seq"] <= seq: continue
+            ops.append((op["op"], op["id"], op["record"]))
+            seq = op["seq"]
+        return ops, seq
+
+    def write_snapshot(self, key, data, seq):
+        return self.write_temp(json.dumps({ **data, "seq": seq }))
+
+    def load(self, key):
+        if self.items[key] is None: return super().load(key)
+        with self.to_lock(key):
+            records, self.seqs[key] = self.replay_all(key)
+            self.seen[key] = self.to_stamp(key)
+        if records is None: return None
+        return self.to_data(key, records)
+
+    def save(self, key, data):
+        if self.items[key] is None: return super().save(key, data)
+        with self.to_lock(key):
+            # A seq of its own, so cached entries reload the new snapshot
+            seq = self.to_seq(key) + 1
+            tmp = self.write_snapshot(key, data, seq)
+            os.replace(tmp, self.to_file(key))
+            self.seqs[key] = seq
+            for suffix in ('', '.old'):
+                journal = self.to_journal(key, suffix)
+                if os.path.exists(journal): os.remove(journal)
+            # Invalidate any compaction already in flight
+            self.epochs[key] += 1
+            self.seen[key] = self.to_stamp(key)
+
+    def commit(self, key, ops):
+        if self.items[key] is None: return super().commit(key, ops)
+        with self.to_lock(key):
+            lines = []
+            seq = self.to_seq(key)
+            for kind, uid, record in ops:
+                seq += 1
+                op = { "seq": seq, "op": kind, "id": uid, "record": record }
+                lines.append(json.dumps(op) + '\n')
+            # One append for the whole batch
+            text = ''.join(lines)
+            started = time.perf_counter()
+            with open(self.to_journal(key), 'a') as f:
+                f.write(text)
+                size = f.tell()
+                # Durable before the writers are told it is done
+                f.flush()
+                os.fsync(f.fileno())
+            self.measure("write", len(text), started)
+            self.seqs[key] = seq
+            if size >= self.limit and key not in self.compacting:
+                self.rotate(key)
+            self.seen[key] = self.to_stamp(key)
+
+    def rotate(self, key):
+        old = self.to_journal(key, '.old')
+        # A leftover journal from a crash is compacted first
+        if not os.path.exists(old):
+            os.replace(self.to_journal(key), old)
+        self.compacting.add(key)
+        epoch = self.epochs[key]
+        Thread(target=self.compact, args=(key, epoch), daemon=True).start()
+
+    def compact(self, key, epoch):
+        try:
+            before = self.to_stamp(key)
+            if before[1] is None: return
+            records, seq = self.replay_all(key, ('.old',))
+            data = self.to_data(key, records or {})
+            tmp = self.write_snapshot(key, data, seq)
+            with self.to_lock(key):
+                # Another worker may have compacted or saved meanwhile
+                changed = self.to_stamp(key)[:2] != before[:2]
+                if self.epochs[key] != epoch or changed:
+                    os.remove(tmp)
+                    return
+                os.replace(tmp, self.to_file(key))
+                os.remove(self.to_journal(key, '.old'))
+        finally:
+            with self.to_lock(key):
+                self.compacting.discard(key)
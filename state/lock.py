@@ -0,0 +1,41 @@
+from threading import RLock
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock, locks only cover threads of one process
+    fcntl = None
+
+class FileLock():
+    def __init__(self, path):
+        self.thread_lock = RLock()
+        self.path = path
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        try:
+            if self.depth == 0 and fcntl is not None:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                # Blocks until other worker processes let go
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        self.depth += 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
@@ -1,17 +1,24 @@
 from pydantic import BaseSettings
-from typing import Dict, List
+from typing import Dict, List, Optional
 from models import HasBasicPage
 from models import HasContact
 from models import HasSurvey
 from models import HasPerson
 from models import HasEvent
-from threading import Lock
+from models import HasChange
+from models import HasFinishedJob
+from .journal import JournalBackend
+from .backend import FileBackend
+from .cache import StateCache
+from .commit import Committer, Write, NEW
+from datetime import datetime, timezone
 from pathlib import Path
-import json
 import os
 
 class Session(BaseSettings):
     token: str
+    refresh_token: Optional[str]
+    expires_at: Optional[float]
 
 class BasicPages(BaseSettings):
     basic_pages: List[HasBasicPage]
@@ -22,42 +29,256 @@ class Surveys(BaseSettings):
 class Contacts(BaseSettings):
     contacts: List[HasContact]
 
+class Changes(BaseSettings):
+    changes: List[HasChange]
+
+class FinishedJobs(BaseSettings):
+    finished_jobs: List[HasFinishedJob]
+
 class Persons(BaseSettings):
     persons: List[HasPerson]
 
 class Events(BaseSettings):
     events: List[HasEvent]
 
+class Sequences(BaseSettings):
+    events: Optional[int]
+    persons: Optional[int]
+    surveys: Optional[int]
+    basic_pages: Optional[int]
+    contacts: Optional[int]
+    changes: Optional[int]
+    finished_jobs: Optional[int]
+
 TYPES = {
     "events": Events,
     "persons": Persons,
     "surveys": Surveys,
     "contacts": Contacts,
+    "changes": Changes,
+    "finished_jobs": FinishedJobs,
     "basic_pages": BasicPages,
+    "sequences": Sequences,
     "session": Session
 }
-LOCKS = { k: Lock() for k in TYPES.keys() }
+# Record field holding each collection's items
+ITEMS = {
+    "events": "event",
+    "persons": "person",
+    "surveys": "survey",
+    "contacts": "contact",
+    "changes": "change",
+    "finished_jobs": "finished_job",
+    "basic_pages": "basic_page",
+    "sequences": None,
+    "session": None
+}
+# Fields that records can be matched or searched on
+INDEXES = {
+    "persons": {
+        "email": ("person", "email"),
+        "last_name": ("person", "last_name"),
+        "first_name": ("person", "first_name"),
+        "state": ("person", "registered_address", "state"),
+        "party": ("person", "party"),
+        "employer": ("person", "employer")
+    },
+    # Each person's contacts, without scanning the whole log
+    "contacts": {
+        "person_id": ("contact", "person_id")
+    },
+    # The latest change to each record
+    "changes": {
+        "resource": ("change", "resource"),
+        "uid": ("change", "uid")
+    }
+}
+# Collections whose writes are logged in the changes feed
+TRACKED = ("persons", "events", "surveys", "basic_pages", "contacts")
+BACKENDS = {
+    "file": FileBackend,
+    "journal": JournalBackend
+}
+BACKEND = os.environ.get('STATE_BACKEND', 'journal')
 DIR = Path(__file__).parent.resolve()
+CACHE = StateCache(TYPES, ITEMS, INDEXES)
+
+def set_backend(name, root=None):
+    global BACKEND_INSTANCE
+    BACKEND_INSTANCE = BACKENDS[name](Path(root or DIR), ITEMS)
+    CACHE.entries.clear()
+
+def to_backend():
+    return BACKEND_INSTANCE
 
 def to_file(key):
-    return DIR.joinpath(f'{key}.json')
+    return to_backend().to_file(key)
 
 def to_lock(key):
-    return LOCKS[key]
+    return to_backend().to_lock(key)
+
+def to_cache_stats():
+    return CACHE.to_stats()
+
+def to_io_stats():
+    return to_backend().to_io_stats()
 
 def to_state(key):
-    filename = to_file(key)
-    if not os.path.exists(filename):
-        return None
-    with open(filename, 'r') as f:
-        try:
-            return TYPES[key](**json.loads(f.read()))
-        except json.JSONDecodeError:
-            return TYPES[key](events=[])
+    return CACHE.get(key, to_backend())
+
+def to_record(key, uid):
+    return CACHE.get_record(key, uid, to_backend())
+
+def to_revision(key):
+    return CACHE.get_revision(key, to_backend())
+
+def to_seq(key):
+    return to_backend().to_seq(key)
+
+def to_page_bytes(key, before, limit):
+    return CACHE.get_page_bytes(key, to_backend(), before, limit)
+
+def to_matches(key, filters, before, limit):
+    return CACHE.get_matches(key, to_backend(), filters, before, limit)
+
+def to_changes(after, limit, updated_since=None, resource=None):
+    match = None
+    if resource is not None:
+        match = lambda e: e.change.resource == resource
+    at = None if updated_since is None else to_timestamp(updated_since)
+    backend = to_backend()
+    return CACHE.get_since('changes', backend, after, limit, at, match)
+
+def to_finished_jobs(after, limit):
+    return CACHE.get_since('finished_jobs', to_backend(), after, limit)
+
+def to_last_id(key):
+    return CACHE.get_last(key, to_backend())
+
+def to_record_bytes(key, uid):
+    return CACHE.get_encoded(key, uid, to_backend())
+
+def to_next_ids(key, count):
+    backend = to_backend()
+    with backend.to_lock('sequences'):
+        sequences = to_state('sequences')
+        sequences = {} if sequences is None else sequences.dict()
+        uid = sequences.get(key, None)
+        # Seed from existing records the first time
+        if uid is None:
+            uids = CACHE.get_uids(key, backend)
+            uid = max([-1, *uids]) + 1
+        set_state('sequences', **{ **sequences, key: uid + count })
+        return list(range(uid, uid + count))
 
 def set_state(key, **kwargs):
-    lock = to_lock(key)
-    lock.acquire()
-    with open(to_file(key), 'w') as f:
-        f.write(json.dumps(kwargs)) 
-    lock.release()
+    backend = to_backend()
+    with backend.to_lock(key):
+        backend.save(key, kwargs)
+        CACHE.save(key, backend.to_stamp(key), kwargs, backend.to_seq(key))
+
+def commit_records(key, ops):
+    backend = to_backend()
+    with backend.to_lock(key):
+        if key not in TRACKED: return commit_ops(backend, key, ops)
+        # Stamped under the changes lock, so stamps grow with change ids
+        with backend.to_lock('changes'):
+            updated_at = to_timestamp()
+            ops = to_stamped(key, ops, updated_at)
+            commit_ops(backend, key, ops)
+            log_changes(key, ops, updated_at)
+        return updated_at
+
+def commit_ops(backend, key, ops):
+    before = backend.to_stamp(key)
+    backend.commit(key, ops)
+    after = backend.to_stamp(key)
+    CACHE.commit(key, before, after, ops, backend.to_seq(key))
+
+def to_timestamp(when=None):
+    # Fixed width UTC stamps sort as text
+    when = datetime.now(timezone.utc) if when is None else when
+    if when.tzinfo is None: when = when.replace(tzinfo=timezone.utc)
+    return when.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+def to_stamped(key, ops, updated_at):
+    item = ITEMS[key]
+    return [
+        (kind, uid, record) if record is None else
+        (kind, uid, { **record, item: { **record[item], "updated_at": updated_at } })
+        for kind, uid, record in ops
+    ]
+
+def log_changes(key, ops, updated_at):
+    ops = [(kind, uid) for kind, uid, _ in ops if uid is not None]
+    if not ops: return
+    backend = to_backend()
+    # Held inside the collection's lock, so changes keep its order
+    with backend.to_lock('changes'):
+        latest, changes = {}, []
+        for seq, (kind, uid) in zip(to_next_ids('changes', len(ops)), ops):
+            filters = { "resource": key, "uid": uid }
+            if uid in latest:
+                prior = [latest[uid]]
+            else:
+                prior = CACHE.get_match_ids('changes', backend, filters)
+            # Each record keeps only its latest change, or tombstone
+            changes.extend(("del", old, None) for old in prior)
+            latest[uid] = seq
+            changes.append(("put", seq, { "change": {
+                "id": seq, "resource": key, "uid": uid,
+                "kind": kind, "updated_at": updated_at
+            }}))
+        commit_records('changes', changes)
+
+def put_records(key, pairs):
+    return commit_records(key, [("put", uid, record) for uid, record in pairs])
+
+def commit_writes(key, writes):
+    backend = to_backend()
+    item = ITEMS[key]
+    with backend.to_lock(key):
+        created = sum(1 for write in writes if write.uid is NEW)
+        uids = iter(to_next_ids(key, created) if created else [])
+        ops, done, latest = [], [], {}
+        for write in writes:
+            try:
+                uid = next(uids) if write.uid is NEW else write.uid
+                record = write.record
+                if write.uid is NEW: record[item]["id"] = uid
+                result = uid
+                if write.change is not None:
+                    # Earlier writes in the batch count as already made
+                    found = latest[uid] if uid in latest else to_found(key, uid)
+                    record = None if found is None else write.change(found)
+                    if record is None:
+                        write.future.set_result(None)
+                        continue
+                    result = record
+                # Deletes only need the id
+                if write.kind == "del": record = None
+                latest[uid] = record
+                ops.append((write.kind, uid, record))
+                done.append((write, result))
+            except Exception as e:
+                write.future.set_exception(e)
+        if ops: commit_records(key, ops)
+    # Requests resolve once their whole batch is on disk
+    for write, result in done: write.future.set_result(result)
+
+def to_found(key, uid):
+    found = to_record(key, uid)
+    return None if found is None else found.dict()
+
+COMMITTER = Committer(commit_writes)
+
+def submit_write(key, kind, uid, record=None, change=None):
+    return COMMITTER.submit(Write(key, kind, uid, record, change))
+
+def submit_call(call):
+    return COMMITTER.submit(Write(None, "call", None, call=call))
+
+def to_commit_stats():
+    return COMMITTER.to_stats()
+
+set_backend(BACKEND)
@@ -271,19 +271,108 @@ class T {
   `
 }
 
+// Background writes report completion on the event stream
+const JOB_WAIT = 5000;
+const JOB_WAITERS = new Map();
+const JOBS_DONE = new Map();
+const STREAM = new EventSource("/api/stream");
+STREAM.addEventListener("job", ({ data }) => {
+  const job = JSON.parse(data);
+  const resolve = JOB_WAITERS.get(job.id);
+  if (resolve) return resolve(job);
+  // Remember jobs that finish before anyone waits for them
+  JOBS_DONE.set(job.id, job);
+  if (JOBS_DONE.size > 100) {
+    JOBS_DONE.delete(JOBS_DONE.keys().next().value);
+  }
+});
+
+// Lists are read once, then kept current by change events
+const ITEMS = {
+  persons: "person", events: "event",
+  surveys: "survey", basic_pages: "basic_page"
+};
+const SOURCES = {
+  persons: (d, list) => d.sources.person = list,
+  events: (d, list) => d.sources.event = list[0] || null,
+  surveys: (d, list) => d.sources.survey = list,
+  basic_pages: (d, list) => d.sources.basic = list
+};
+const LISTS = new Map();
+const CHANGES = { live: false, d: null };
+STREAM.addEventListener("ready", ({ data }) => {
+  CHANGES.live = JSON.parse(data).changes;
+});
+STREAM.addEventListener("error", () => {
+  // Changes missed while disconnected are only in a new list
+  CHANGES.live = false;
+  LISTS.clear();
+});
+STREAM.addEventListener("change", ({ data }) => {
+  const change = JSON.parse(data);
+  const { resource, uid } = change;
+  if (!LISTS.has(resource)) return;
+  const record = change[ITEMS[resource]];
+  const list = LISTS.get(resource).filter(({ id }) => id !== uid);
+  if (record) list.push(record);
+  // Lists are newest first
+  list.sort((a, b) => b.id - a.id);
+  LISTS.set(resource, list);
+  if (CHANGES.d && resource in SOURCES) {
+    SOURCES[resource](CHANGES.d, list);
+  }
+});
+
+const watchChanges = (d) => {
+  CHANGES.d = d;
+}
+
+const readList = async (resource, url) => {
+  if (CHANGES.live && LISTS.has(resource)) {
+    return LISTS.get(resource);
+  }
+  const response = await fetch(url);
+  const { results } = await response.json();
+  if (CHANGES.live) LISTS.set(resource, results || []);
+  return results || [];
+}
+
+const toJobId = async (response) => {
+  // Deletes have no body, only the Location header
+  const location = response.headers.get("Location") || "";
+  const found = location.match(/\/api\/jobs\/([^/]+)$/);
+  if (found) return found[1];
+  const { job } = await response.json().catch(() => ({}));
+  return job?.id || null;
+}
+
+const toJobDone = async (response) => {
+  const job_id = await toJobId(response);
+  if (!job_id) return null;
+  if (JOBS_DONE.has(job_id)) return JOBS_DONE.get(job_id);
+  const done = await new Promise(resolve => {
+    JOB_WAITERS.set(job_id, resolve);
+    setTimeout(() => resolve(null), JOB_WAIT);
+  });
+  JOB_WAITERS.delete(job_id);
+  return done;
+}
+
 const deleteAPI = async (url) => {
-  return await fetch(url, {
+  const response = await fetch(url, {
     method: "DELETE", cache: "no-cache",
     headers: { "Content-Type": "application/json" }
   });
+  return await toJobDone(response);
 }
 
 const sendData = async (data, url, method) => {
-  return await fetch(url, {
+  const response = await fetch(url, {
     method, cache: "no-cache",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify(data),
-  })
+  });
+  return await toJobDone(response);
 }
 
 const toTestForms = (name) => {
@@ -381,19 +470,15 @@ const updateEvent = async (d, data) => {
   const url = `/api/pages/events/${ev_id}`;
   const get_url = "/api/pages/events";
   await sendData(data, url, 'PUT');
-  const response = await fetch(get_url);
-  const { results } = await response.json();
-  if (!results?.length) return null;
-  return results[0];
+  const results = await readList("events", get_url);
+  return results[0] || null;
 }
 
 const createEvent = async (data) => {
   const url = "/api/pages/events";
   await sendData(data, url, 'POST');
-  const response = await fetch(url);
-  const { results } = await response.json();
-  if (!results?.length) return null;
-  return results[0];
+  const results = await readList("events", url);
+  return results[0] || null;
 }
 
 const toBasicMessage = (basic) => {
@@ -412,9 +497,8 @@ const updatePerson = async (d, data) => {
   const url = `/api/people/${who_id}`;
   const get_url = "/api/people";
   await sendData(data, url, 'PUT');
-  const response = await fetch(get_url);
-  const { results } = await response.json();
-  if (!results?.length) return null;
+  const results = await readList("persons", get_url);
+  if (!results.length) return null;
   const basic = await createBasic(toMockBasic(results));
   const update = toUpdater(toBasicMessage(basic));
   d.tests.basic.forms = d.tests.basic.forms.map(update);
@@ -424,13 +508,12 @@ const updatePerson = async (d, data) => {
 
 const deletePerson = async (who_id, d) => {
   await deleteAPI(`/api/people/${who_id}`);
-  const response = await fetch('/api/people');
-  const { results } = await response.json();
+  const results = await readList("persons", "/api/people");
   const basic = await createBasic(toMockBasic(results));
   const update = toUpdater(toBasicMessage(basic));
   d.tests.basic.forms = d.tests.basic.forms.map(update);
   d.sources.basic = basic;
-  return results || [];
+  return results;
 }
 
 const createPerson = async (d, data) => {
@@ -438,13 +521,12 @@ const createPerson = async (d, data) => {
   if (data !== null) {
     await sendData(data, url, 'POST');
   }
-  const response = await fetch(url);
-  const { results } = await response.json();
+  const results = await readList("persons", url);
   const basic = await createBasic(toMockBasic(results));
   const update = toUpdater(toBasicMessage(basic));
   d.tests.basic.forms = d.tests.basic.forms.map(update);
   d.sources.basic = basic;
-  return results || [];
+  return results;
 }
 
 const createSurvey = async (d, data) => {
@@ -452,9 +534,7 @@ const createSurvey = async (d, data) => {
   if (data !== null) {
     await sendData(data, url, 'POST');
   }
-  const response = await fetch(url);
-  const { results } = await response.json();
-  return results || [];
+  return await readList("surveys", url);
 }
 
 const createBasic = async (to_basic) => {
@@ -467,9 +547,7 @@ const createBasic = async (to_basic) => {
     await new Promise(r => setTimeout(r, 10));
     await sendData(data[0], url, 'POST');
   }
-  const response = await fetch(url);
-  const { results } = await response.json();
-  return results || [];
+  return await readList("basic_pages", url);
 }
 
 const toRoot = (core) => {
@@ -1323,6 +1401,7 @@ const main = () => {
   const id = 'api-root';
   const cal_id = "event-calendar";
   const data = reactive(toDefault());
+  watchChanges(data);
   observe(data, id, cal_id);
   const core = toPageCore(data, toSections(cal_id));
   const el = document.getElementById(id);
@@ -1,8 +1,8 @@
 from argparse import ArgumentParser
-from signal import SIGINT, SIGTERM
 from util import set_config
-import asyncio
 import uvicorn
+import time
+import os
 
 PORT = 8080
 NATION = "greenrainbow"
@@ -10,6 +10,21 @@ NATION = "greenrainbow"
 def to_help(label):
     if label == 'L': return 'local testing, without credentials'
     if label == 'URL': return 'custom live app redirect URL'
+    if label == 'pool': return 'max pooled connections to the API'
+    if label == 'timeout': return 'seconds before an API call times out'
+    if label == 'concurrency': return 'max concurrent API writes'
+    if label == 'queue': return 'max queued API writes before HTTP 429'
+    if label == 'coalesce': return 'seconds to merge updates to one record (0 to send each)'
+    if label == 'rate': return 'max API requests per second, per token (0 for no limit)'
+    if label == 'mock-rate': return 'mock-up API requests per second (0 for no limit)'
+    if label == 'cache': return 'seconds to cache API lists (0 for no cache)'
+    if label == 'workers': return 'worker processes (more than 1 disables reload)'
+    if label == 'production': return 'no reload, and a worker per core unless --workers is given'
+    if label == 'loop': return 'event loop (auto uses uvloop when installed)'
+    if label == 'http': return 'HTTP parser (auto uses httptools when installed)'
+    if label == 'profile': return 'fraction of requests to profile (0 for none)'
+    if label == 'profile-dir': return 'directory for request profiles'
+    if label == 'profile-header': return 'profile requests sent with "X-Profile: 1"'
     return f'API Client {label} for "{NATION}"'
 
 parser = ArgumentParser(
@@ -20,11 +35,31 @@ parser.add_argument('redirect', nargs='?', help=to_help('URL'))
 parser.add_argument('client_id', nargs='?', help=to_help('ID'))
 parser.add_argument('client_secret', nargs='?', help=to_help('Secret'))
 parser.add_argument('-L', '--local', help=to_help('L'), action='store_true')
+parser.add_argument('--pool-size', type=int, default=10, help=to_help('pool'))
+parser.add_argument('--timeout', type=float, default=10.0, help=to_help('timeout'))
+parser.add_argument('--concurrency', type=int, default=4, help=to_help('concurrency'))
+parser.add_argument('--queue-size', type=int, default=1000, help=to_help('queue'))
+parser.add_argument('--coalesce-window', type=float, default=0.25, help=to_help('coalesce'))
+parser.add_argument('--rate-limit', type=float, default=10.0, help=to_help('rate'))
+parser.add_argument('--mock-rate-limit', type=float, default=0.0, help=to_help('mock-rate'))
+parser.add_argument('--cache-ttl', type=float, default=30.0, help=to_help('cache'))
+parser.add_argument('--workers', type=int, help=to_help('workers'))
+parser.add_argument('--production', help=to_help('production'), action='store_true')
+parser.add_argument('--loop', choices=['auto', 'asyncio', 'uvloop'], default='auto', help=to_help('loop'))
+parser.add_argument('--http', choices=['auto', 'h11', 'httptools'], default='auto', help=to_help('http'))
+parser.add_argument('--profile-rate', type=float, default=0.0, help=to_help('profile'))
+parser.add_argument('--profile-dir', default='profiles', help=to_help('profile-dir'))
+parser.add_argument('--profile-header', help=to_help('profile-header'), action='store_true')
 
-async def mockup():
+def mockup(workers, reload, production, loop, http):
+    # State is shared between workers through lock files
     uvicorn.run(**{
         "port": PORT,
-        "reload": True,
+        "reload": reload,
+        "workers": workers,
+        "loop": loop,
+        "http": http,
+        "access_log": not production,
         "host": "0.0.0.0",
         "app": "mockup:nationbuilder"
     })
@@ -43,11 +78,20 @@ if __name__ == "__main__":
     # Ensure redirect has protocol
     if args.redirect:
         if not args.redirect.startswith('http'):
-            args.redirect = f'{protocol}{args.redirect}'
+            args.redirect = f'{args.protocol}{args.redirect}'
         args.redirect = f'{args.redirect}/api/redirect'
+    # Production runs a worker per core by default
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if args.production else 1
+    # Launch options are for uvicorn, not the app
+    launch = { k: vars(args).pop(k) for k in ('production', 'loop', 'http') }
+    launch["reload"] = not launch["production"] and args.workers == 1
     # Configure API
     set_config(**{
-        **vars(args), "port": PORT, "nation": NATION
+        **vars(args), "port": PORT, "nation": NATION,
+        # Workers report their startup time against this, unless
+        # the reloader restarts them long after launch
+        "launched_at": 0.0 if launch["reload"] else time.time()
     })
 
     # Test the API
@@ -55,12 +99,5 @@ if __name__ == "__main__":
     elif not args.client_id: print(f'Missing {to_help("ID")}')
     elif not args.client_secret: print(f'Missing {to_help("Secret")}')
     else:
-        # Run API server + client
-        loop = asyncio.get_event_loop()
-        main_task = asyncio.ensure_future(mockup())
-        for signal in [SIGINT, SIGTERM]:
-            loop.add_signal_handler(signal, main_task.cancel)
-        try:
-            loop.run_until_complete(main_task)
-        finally:
-            loop.close()
+        # Run API server, which handles its own signals
+        mockup(args.workers, **launch)
@@ -0,0 +1,64 @@
+from pathlib import Path
+import sys
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+import state.state as S
+
+def to_person(uid, **fields):
+    return { "person": {
+        "id": uid, "email": f'p{uid}@example.com', "last_name": "Last",
+        "first_name": "First", "sex": "F", "signup_type": 0, "employer": "E",
+        "party": "P", "registered_address": { "state": "MA", "country_code": "US" },
+        **fields
+    }}
+
+@pytest.fixture
+def root(tmp_path):
+    # Each test gets its own state directory, restored afterwards
+    S.set_backend('journal', tmp_path)
+    yield tmp_path
+    S.set_backend(S.BACKEND)
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # The mockup reads its configuration once, on import
+    import util.config
+    config_file = util.config.CONFIG
+    util.config.CONFIG = str(tmp_path_factory.mktemp('config') / 'env.json')
+    util.config.set_config(
+        port=8080, nation='test', local=True, protocol='http://',
+        redirect='http://localhost:8080/api/redirect',
+        client_id='local', client_secret='local'
+    )
+    util.config.to_config.cache_clear()
+    from mockup import nationbuilder
+    yield nationbuilder
+    util.config.CONFIG = config_file
+    util.config.to_config.cache_clear()
+
+@pytest.fixture
+def client(app, root, monkeypatch):
+    # The proxy calls the mockup in-process, with a fixed token
+    from fastapi.testclient import TestClient
+    from util import to_config, to_service, to_dispatcher
+    import mockup.mockup as M
+    import httpx
+    async def to_token(config): return 'token'
+    monkeypatch.setattr(M, 'to_token', to_token)
+    # Each startup adds its own listener for finished jobs
+    monkeypatch.setattr(to_dispatcher(to_config()), 'listeners', [])
+    service = to_service(to_config())
+    with TestClient(app) as client:
+        transport = httpx.ASGITransport(app=app)
+        service.client = httpx.AsyncClient(
+            transport=transport, base_url='http://localhost:8080'
+        )
+        yield client
+    # Finished jobs are saved, then trimmed, in the background
+    for _ in range(2): S.submit_call(lambda: None).result()
+    # Tags restart with each state directory, so nothing carries over
+    M.to_response_cache(to_config()).entries.clear()
+    service.validators.clear()
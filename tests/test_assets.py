@@ -0,0 +1,37 @@
+from util.assets import Asset, to_accepted, to_asset
+import util.assets
+
+def test_accepted_encodings_and_weights():
+    assert to_accepted('gzip, br;q=0.5, identity;q=0') == {
+        'gzip': 1.0, 'br': 0.5, 'identity': 0.0
+    }
+    assert to_accepted('GZIP;q=bad, ,*') == { 'gzip': 0.0, '*': 1.0 }
+    assert to_accepted(None) == {}
+
+def test_encoding_follows_accept_encoding(monkeypatch):
+    monkeypatch.setattr(util.assets, 'brotli', None)
+    asset = Asset(b'a' * 1000, 'text/javascript', ())
+    assert asset.to_encoding('gzip, deflate') == 'gzip'
+    assert asset.to_encoding('br') == 'identity'
+    assert asset.to_encoding('gzip;q=0') == 'identity'
+    assert asset.to_encoding('*') == 'gzip'
+    assert asset.to_encoding(None) == 'identity'
+    assert asset.to_etag('gzip') == f'"{asset.version}-gzip"'
+
+def test_small_bodies_are_not_compressed():
+    asset = Asset(b'a', 'text/javascript', ())
+    assert list(asset.bodies) == ['identity']
+    assert asset.to_encoding('gzip, br') == 'identity'
+
+def test_pages_link_scripts_by_version(tmp_path):
+    page, script = tmp_path / 'index.html', tmp_path / 'index.js'
+    page.write_text('<script src="./index.js"></script>')
+    script.write_text('main();')
+    first = to_asset(str(page), [str(script)])
+    version = to_asset(str(script)).version
+    assert f'"./index.js?v={version}"'.encode('utf-8') in first.bodies['identity']
+    assert to_asset(str(page), [str(script)]) is first
+    # Changing a script changes the page that links to it
+    script.write_text('main(1);')
+    assert to_asset(str(page), [str(script)]).version != first.version
+    assert first.to_cache_control(first.version) != first.to_cache_control(None)
@@ -0,0 +1,46 @@
+from conftest import to_person
+import json
+
+M = '/mockup/api/v1'
+
+def to_new(i, **fields):
+    person = to_person(None, email=f'p{i}@example.com', **fields)["person"]
+    person.pop("id")
+    return { "person": person }
+
+def test_proxy_reports_each_item_in_order(client):
+    people = [to_new(i) for i in range(150)]
+    people[3] = { "person": { "email": "missing-fields@example.com" } }
+    r = client.post('/api/people/bulk', json=people)
+    results = r.json()["results"]
+    # Sent upstream in chunks of 100, without the invalid item
+    assert [e["index"] for e in results] == list(range(150))
+    assert results[3]["status"] == 422
+    assert {e["status"] for e in results[:3] + results[4:]} == {201}
+    listed = client.get(f'{M}/people?format=json&limit=100').json()
+    assert len(listed["results"]) == 100 and listed["next"]
+
+def test_proxy_reads_ndjson(client):
+    body = '\n'.join(json.dumps(to_new(i)) for i in range(2)) + '\n\n'
+    headers = { 'content-type': 'application/x-ndjson' }
+    r = client.post('/api/people/bulk', content=body, headers=headers)
+    assert [e["status"] for e in r.json()["results"]] == [201, 201]
+
+def test_proxy_rejects_bodies_that_are_not_lists(client):
+    assert client.post('/api/people/bulk', json=to_new(0)).status_code == 400
+    r = client.post('/api/people/bulk', content='[', headers={ 'content-type': 'application/json' })
+    assert r.status_code == 400
+
+def test_mockup_updates_build_on_each_other(client):
+    client.post(f'{M}/people/bulk', json=[to_new(0)])
+    r = client.post(f'{M}/people/bulk', json=[
+        { "person": { "id": 0, "party": "Q" } },
+        { "person": { "id": 0, "employer": "F" } },
+        { "person": { "id": 9, "party": "Q" } },
+        to_new(1)
+    ])
+    results = r.json()["results"]
+    assert [e["status"] for e in results] == [200, 200, 404, 201]
+    person = client.get(f'{M}/people/match?format=json&email=p0@example.com').json()
+    assert (person["person"]["party"], person["person"]["employer"]) == ("Q", "F")
+    assert results[3]["person"]["id"] == 1
@@ -0,0 +1,45 @@
+from util.cache import ResponseCache
+import time
+
+def test_writes_drop_only_their_resource():
+    cache = ResponseCache(30.0, 1024)
+    cache.set('people', '/people', b'[1]', 0, '"a"')
+    cache.set('events', '/pages/events', b'[2]', 0)
+    cache.invalidate('/people')
+    assert cache.get('people') is None
+    assert cache.get('events') == (b'[2]', None)
+    assert cache.to_stats()["hits"] == 1 and cache.to_stats()["misses"] == 1
+
+def test_lists_read_before_a_write_are_not_kept():
+    cache = ResponseCache(30.0, 1024)
+    generation = cache.to_generation('/people')
+    # The write lands while the list is still being read
+    cache.invalidate('/people')
+    cache.set('people', '/people', b'[1]', generation)
+    assert cache.get('people') is None
+    cache.set('people', '/people', b'[1, 2]', cache.to_generation('/people'))
+    assert cache.get('people') == (b'[1, 2]', None)
+
+def test_entries_expire():
+    cache = ResponseCache(0.01, 1024)
+    cache.set('people', '/people', b'[1]', 0)
+    time.sleep(0.02)
+    assert cache.get('people') is None
+    assert cache.to_stats()["bytes"] == 0
+
+def test_size_limit_evicts_least_recently_used():
+    cache = ResponseCache(30.0, 8)
+    cache.set('a', '/a', b'aaaa', 0)
+    cache.set('b', '/b', b'bbbb', 0)
+    cache.get('a')
+    cache.set('c', '/c', b'cccc', 0)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    # Bodies bigger than the whole cache are never kept
+    cache.set('d', '/d', b'd' * 9, 0)
+    assert cache.get('d') is None and cache.to_stats()["bytes"] == 8
+
+def test_no_ttl_is_no_cache():
+    cache = ResponseCache(0, 1024)
+    cache.set('people', '/people', b'[1]', 0)
+    assert cache.get('people') is None
@@ -0,0 +1,52 @@
+from conftest import to_person
+from threading import Thread
+from urllib.parse import urlencode
+import json
+import state.state as S
+
+M = '/mockup/api/v1'
+
+def to_new(i):
+    person = to_person(None, email=f'p{i}@example.com')["person"]
+    person.pop("id")
+    return { "person": person }
+
+def to_feed(client, **params):
+    return client.get(f'{M}/changes?{urlencode({ "format": "json", **params })}').json()
+
+def test_feed_keeps_the_latest_change_per_record(client):
+    for i in range(3): client.post(f'{M}/people', json=to_new(i))
+    client.put(f'{M}/people/0', json={ "person": { "party": "Q" } })
+    client.delete(f'{M}/people/1')
+    feed = to_feed(client, limit=2)
+    assert [(c["uid"], c["kind"]) for c in feed["results"]] == [(2, "put"), (0, "put")]
+    assert feed["results"][1]["person"]["party"] == "Q"
+    feed = to_feed(client, since=feed["since"])
+    assert [(c["uid"], c["kind"], c["person"]) for c in feed["results"]] == [(1, "del", None)]
+    assert feed["next"] is None and to_feed(client, since=feed["since"])["results"] == []
+
+def test_feed_from_a_time_and_one_resource(client):
+    for i in range(2): client.post(f'{M}/people', json=to_new(i))
+    at = to_feed(client)["results"][-1]["updated_at"]
+    client.post(f'{M}/people', json=to_new(2))
+    feed = to_feed(client, updated_since=at)
+    assert [c["uid"] for c in feed["results"]] == [1, 2]
+    assert to_feed(client, resource="events")["results"] == []
+    assert client.get(f'{M}/changes?format=json&resource=people').status_code == 400
+
+def test_stamps_grow_with_change_ids(root):
+    # Collections are written concurrently, under their own locks
+    def write(key):
+        for uid in range(50):
+            S.put_records(key, [(uid, { S.ITEMS[key]: { "id": uid } })])
+    threads = [Thread(target=write, args=(key,)) for key in ("persons", "events")]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    found, _, _ = S.to_changes(None, 200)
+    stamps = [json.loads(encoded)["updated_at"] for encoded in found]
+    assert len(stamps) == 100 and stamps == sorted(stamps)
+
+def test_bulk_results_carry_their_stamp(client):
+    r = client.post(f'{M}/people/bulk', json=[to_new(0), to_new(1)])
+    stamps = [e["person"]["updated_at"] for e in r.json()["results"]]
+    assert stamps[0] is not None and stamps == [to_feed(client)["results"][0]["updated_at"]] * 2
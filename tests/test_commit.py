@@ -0,0 +1,64 @@
+from state.commit import Committer, Write, NEW
+from conftest import to_person
+import state.state as S
+import pytest
+
+def to_log(batch, log=None):
+    log = [] if log is None else log
+    def commit(key, writes):
+        log.append((key, [w.uid for w in writes]))
+        for write in writes: write.future.set_result(write.uid)
+    Committer(commit).commit_batch(batch)
+    return log
+
+def test_calls_follow_earlier_writes():
+    log = []
+    call = Write(None, "call", None, call=lambda: log.append("call"))
+    batch = [Write('a', "put", 1), Write('b', "del", 2), call, Write('a', "put", 3)]
+    to_log(batch, log)
+    assert log == [('a', [1]), ('b', [2]), "call", ('a', [3])]
+
+def test_writes_group_by_collection():
+    batch = [Write('a', "put", 1), Write('b', "put", 2), Write('a', "del", 1)]
+    assert to_log(batch) == [('a', [1, 1]), ('b', [2])]
+
+def test_failed_commits_fail_their_group():
+    def commit(key, writes):
+        if key == 'a': raise OSError('disk full')
+        for write in writes: write.future.set_result(write.uid)
+    a, b = Write('a', "put", 1), Write('b', "put", 2)
+    Committer(commit).commit_batch([a, b])
+    with pytest.raises(OSError): a.future.result()
+    assert b.future.result() == 2
+
+def test_changes_see_earlier_writes_in_batch(root):
+    def rename(name):
+        def change(found):
+            found["person"]["last_name"] += name
+            return found
+        return change
+    batch = [
+        Write('persons', "put", NEW, to_person(None)),
+        Write('persons', "put", 0, change=rename("-a")),
+        Write('persons', "put", 0, change=rename("-b")),
+        Write('persons', "del", 0, change=lambda found: found),
+        Write('persons', "put", 0, change=rename("-c"))
+    ]
+    S.commit_writes('persons', batch)
+    results = [write.future.result() for write in batch]
+    assert results[0] == 0
+    assert results[2]["person"]["last_name"] == "Last-a-b"
+    # Changes to a record deleted earlier in the batch find nothing
+    assert results[3] is not None and results[4] is None
+    assert S.to_record('persons', 0) is None
+
+def test_submitted_writes_resolve_in_order(root):
+    futures = [S.submit_write('persons', "put", NEW, to_person(None)) for _ in range(3)]
+    futures.append(S.submit_call(lambda: S.CACHE.get_uids('persons', S.to_backend())))
+    futures.append(S.submit_write('persons', "del", 1))
+    assert [f.result(5) for f in futures[:3]] == [0, 1, 2]
+    assert futures[3].result(5) == [0, 1, 2]
+    futures[4].result(5)
+    assert S.to_record('persons', 1) is None
+    kinds = [c.change.kind for c in S.to_state('changes').changes]
+    assert sorted(kinds) == ["del", "put", "put"]
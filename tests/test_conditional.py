@@ -0,0 +1,41 @@
+from conftest import to_person
+
+M = '/mockup/api/v1'
+
+def to_people(count):
+    people = [to_person(None)["person"] for _ in range(count)]
+    for person in people: person.pop("id")
+    return [{ "person": person } for person in people]
+
+def test_mockup_pages_revalidate_until_a_write(client):
+    client.post(f'{M}/people/bulk', json=to_people(3))
+    r = client.get(f'{M}/people?format=json&limit=2')
+    etag = r.headers['etag']
+    r = client.get(f'{M}/people?format=json&limit=2', headers={ 'if-none-match': etag })
+    assert r.status_code == 304 and r.headers['etag'] == etag
+    client.post(f'{M}/people/bulk', json=to_people(1))
+    r = client.get(f'{M}/people?format=json&limit=2', headers={ 'if-none-match': etag })
+    assert r.status_code == 200 and r.headers['etag'] != etag
+
+def test_streamed_lists_are_untagged_until_cached(client):
+    # More than one upstream page, so the tag combines every page
+    client.post(f'{M}/people/bulk', json=to_people(101))
+    r = client.get('/api/people')
+    assert len(r.json()["results"]) == 101 and 'etag' not in r.headers
+    etag = client.get('/api/people').headers['etag']
+    r = client.get('/api/people', headers={ 'if-none-match': etag })
+    assert r.status_code == 304
+
+def test_revalidation_matches_the_cached_tag(client):
+    from util import to_config, to_response_cache
+    client.post(f'{M}/people/bulk', json=to_people(101))
+    client.get('/api/people')
+    etag = client.get('/api/people').headers['etag']
+    # Without the cached list, every upstream page is revalidated
+    to_response_cache(to_config()).entries.clear()
+    r = client.get('/api/people', headers={ 'if-none-match': etag })
+    assert r.status_code == 304 and r.headers['etag'] == etag
+    client.post(f'{M}/people/bulk', json=to_people(1))
+    to_response_cache(to_config()).entries.clear()
+    r = client.get('/api/people', headers={ 'if-none-match': etag })
+    assert r.status_code == 200 and len(r.json()["results"]) == 102
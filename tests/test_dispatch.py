@@ -0,0 +1,99 @@
+from util.dispatch import Dispatcher, QueueFull
+from util.coalesce import Coalescer, to_merged
+import asyncio
+import pytest
+
+class Response():
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def run(main):
+    return asyncio.run(main())
+
+def to_write(log, name, status_code=200, delay=0.0):
+    async def write():
+        log.append(f'{name} start')
+        await asyncio.sleep(delay)
+        log.append(f'{name} end')
+        return Response(status_code)
+    return write
+
+def test_writes_to_one_target_run_in_order():
+    async def main():
+        dispatcher, log = Dispatcher(4, 10), []
+        jobs = [
+            dispatcher.submit('/people/1', to_write(log, 'a', delay=0.02)),
+            dispatcher.submit('/people/2', to_write(log, 'b')),
+            dispatcher.submit('/people/1', to_write(log, 'c'))
+        ]
+        await asyncio.gather(*[job.task for job in jobs])
+        return dispatcher, log, jobs
+    dispatcher, log, jobs = run(main)
+    # Other targets go ahead, the same target waits its turn
+    assert log.index('b end') < log.index('a end') < log.index('c start')
+    assert [job.status for job in jobs] == ["done"] * 3
+    assert dispatcher.tails == {} and dispatcher.pending == 0
+
+def test_job_status():
+    async def main():
+        dispatcher, log = Dispatcher(2, 10), []
+        async def no_token(): return None
+        async def broken(): raise ValueError('bad body')
+        jobs = [
+            dispatcher.submit(None, to_write(log, 'a', 422)),
+            dispatcher.submit(None, no_token),
+            dispatcher.submit(None, broken)
+        ]
+        await asyncio.gather(*[job.task for job in jobs])
+        return jobs
+    failed, no_token, broken = run(main)
+    assert (failed.status, failed.status_code) == ("failed", 422)
+    assert (no_token.status, no_token.error) == ("failed", "no token")
+    assert (broken.status, broken.error) == ("failed", "ValueError: bad body")
+
+def test_full_queue_and_listeners():
+    async def main():
+        dispatcher, log, finished = Dispatcher(1, 2), [], []
+        dispatcher.listeners.append(finished.append)
+        jobs = [dispatcher.submit(None, to_write(log, n)) for n in 'ab']
+        with pytest.raises(QueueFull):
+            dispatcher.submit(None, to_write(log, 'c'))
+        await asyncio.gather(*[job.task for job in jobs])
+        return jobs, finished
+    jobs, finished = run(main)
+    assert finished == jobs
+
+def test_only_the_last_write_to_a_target_is_open():
+    async def main():
+        dispatcher, log = Dispatcher(1, 10), []
+        first = dispatcher.submit('/people/1', to_write(log, 'a'), delay=0.01)
+        assert dispatcher.is_last('/people/1', first)
+        second = dispatcher.submit('/people/1', to_write(log, 'b'))
+        assert not dispatcher.is_last('/people/1', first)
+        assert dispatcher.is_last('/people/1', second)
+        await second.task
+        assert not dispatcher.is_last('/people/1', second)
+    run(main)
+
+def test_merged_fields():
+    base = { "person": { "email": "a@x", "address": { "city": "A", "zip": "1" } } }
+    update = { "person": { "address": { "city": "B" }, "party": "P" } }
+    assert to_merged(base, update) == { "person": {
+        "email": "a@x", "address": { "city": "B", "zip": "1" }, "party": "P"
+    }}
+
+def test_coalescer_releases_only_its_own_write():
+    coalescer = Coalescer(0.25)
+    update = { "person": { "email": "a@x" } }
+    coalescer.hold('/people/1', 'job-a', update)
+    coalescer.merge('/people', '/people/1', { "person": { "party": "P" } })
+    assert update == { "person": { "email": "a@x", "party": "P" } }
+    coalescer.hold('/people/1', 'job-b', { "person": {} })
+    # A write already on its way leaves the newer one held
+    coalescer.release('/people/1', 'job-a')
+    assert coalescer.to_held('/people/1') == 'job-b'
+    coalescer.release('/people/1', 'job-b')
+    assert coalescer.to_held('/people/1') is None
+    assert coalescer.to_stats() == {
+        "window": 0.25, "pending": 0, "merged": 1, "sent": 2
+    }
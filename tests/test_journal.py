@@ -0,0 +1,130 @@
+from state.journal import JournalBackend
+from threading import Thread
+import state.journal
+from state.cache import StateCache
+from conftest import to_person, ROOT
+import state.state as S
+import subprocess
+import json
+import time
+import sys
+import os
+
+def to_ids(backend, key='persons'):
+    data = backend.load(key)
+    return [e["person"]["id"] for e in data[key]]
+
+def to_backend(root, limit=1 << 20):
+    return JournalBackend(root, S.ITEMS, limit)
+
+def test_replay_after_crash_mid_compaction(root):
+    backend = to_backend(root)
+    backend.commit('persons', [("put", i, to_person(i)) for i in range(3)])
+    # Crashed after rotating, before the snapshot replaced the journal
+    os.replace(backend.to_journal('persons'), backend.to_journal('persons', '.old'))
+    backend.commit('persons', [("put", 3, to_person(3)), ("del", 0, None)])
+    # And crashed partway through an append
+    with open(backend.to_journal('persons'), 'a') as f:
+        f.write('{"seq": 6, "op": "put", "id": 9, "rec')
+    restarted = to_backend(root)
+    assert to_ids(restarted) == [3, 2, 1]
+    assert restarted.to_seq('persons') == 5
+
+def test_leftover_journal_is_compacted_first(root):
+    to_backend(root).commit('persons', [("put", 0, to_person(0))])
+    backend = to_backend(root, limit=1)
+    os.replace(backend.to_journal('persons'), backend.to_journal('persons', '.old'))
+    # Rotating again keeps the new journal until the leftover is compacted
+    backend.commit('persons', [("put", 1, to_person(1))])
+    wait_compacted(backend, 'persons')
+    assert os.path.exists(backend.to_journal('persons'))
+    assert to_ids(to_backend(root)) == [1, 0]
+
+def test_compaction_during_writes(root):
+    backend = to_backend(root, limit=2000)
+    for i in range(200):
+        backend.commit('persons', [("put", i, to_person(i))])
+        if i % 3 == 0: backend.commit('persons', [("del", i, None)])
+    wait_compacted(backend, 'persons')
+    kept = [i for i in reversed(range(200)) if i % 3]
+    assert to_ids(to_backend(root)) == kept
+    assert to_backend(root).to_seq('persons') == 200 + 67
+
+def test_save_outranks_cached_seq(root):
+    backend = to_backend(root)
+    backend.commit('persons', [("put", 0, to_person(0))])
+    backend.save('persons', { "persons": [to_person(5)] })
+    backend.commit('persons', [("put", 6, to_person(6))])
+    assert backend.to_seq('persons') == 3
+    assert to_ids(to_backend(root)) == [6, 5]
+
+def test_catch_up_replays_appends(root):
+    S.put_records('persons', [(0, to_person(0))])
+    # A second worker, with its own backend and cache
+    backend = to_backend(root)
+    cache = StateCache(S.TYPES, S.ITEMS, S.INDEXES)
+    assert cache.get_record('persons', 0, backend) is not None
+    S.put_records('persons', [(1, to_person(1, last_name="Later"))])
+    backend.load = fail_load
+    assert cache.get_record('persons', 1, backend).person.last_name == "Later"
+
+def test_catch_up_across_rotations(root, monkeypatch):
+    # Compactions wait until the reader has looked, as a busy writer's might not
+    deferred = []
+    class Deferred(Thread):
+        def start(self): deferred.append(self)
+    monkeypatch.setattr(state.journal, 'Thread', Deferred)
+    writer = to_backend(root, limit=4000)
+    S.put_records('persons', [(1000, to_person(1000))])
+    assert S.to_record('persons', 1000) is not None
+    loads, compactions = count_loads(S.to_backend()), 0
+    for i in range(300):
+        writer.commit('persons', [("put", i, to_person(i))])
+        assert S.to_record('persons', i) is not None
+        while deferred:
+            compaction = deferred.pop()
+            Thread.start(compaction)
+            compaction.join()
+            compactions += 1
+    # Rotations and compactions by the writer are caught up on, not reloaded
+    assert compactions > 10 and loads == [0]
+    assert not os.path.exists(writer.to_journal('persons', '.old'))
+    entry = S.CACHE.entries['persons']
+    assert len(entry.records) == 301
+    assert entry.seq == S.to_backend().to_disk_seq('persons')
+
+def test_catch_up_across_processes(root):
+    S.put_records('persons', [(1000, to_person(1000))])
+    assert S.to_record('persons', 1000) is not None
+    loads = count_loads(S.to_backend())
+    writer = subprocess.run([sys.executable, '-c', WRITER, str(root)], cwd=ROOT)
+    assert writer.returncode == 0
+    assert S.to_record('persons', 299) is not None
+    assert loads == [0]
+
+WRITER = '''
+import sys
+sys.path.insert(0, 'tests')
+from conftest import to_person
+import state.state as S
+S.set_backend('journal', sys.argv[1])
+for i in range(300):
+    S.put_records('persons', [(i, to_person(i))])
+'''
+
+def fail_load(key):
+    raise AssertionError(f'{key} was reloaded')
+
+def count_loads(backend):
+    loads, load = [0], backend.load
+    def counted(key):
+        loads[0] += key == 'persons'
+        return load(key)
+    backend.load = counted
+    return loads
+
+def wait_compacted(backend, key, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while key in backend.compacting or os.path.exists(backend.to_journal(key, '.old')):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
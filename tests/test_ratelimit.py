@@ -0,0 +1,46 @@
+from util.ratelimit import Bucket, Scheduler, READ, WRITE
+import asyncio
+import time
+
+def run(main):
+    return asyncio.run(main())
+
+def test_bucket_spends_its_burst_then_waits():
+    bucket = Bucket(10.0, 2)
+    assert bucket.take() and bucket.take()
+    assert not bucket.take()
+    # One token comes back every tenth of a second
+    assert 0.0 < bucket.to_wait() <= 0.1
+
+def test_bucket_without_a_rate_is_unlimited():
+    bucket = Bucket(0.0, 1)
+    assert all(bucket.take() for _ in range(100))
+    assert bucket.to_wait() == 0.0
+
+def test_bucket_follows_server_headers():
+    bucket = Bucket(0.0, 10)
+    reset = time.time() + 5
+    bucket.update({ 'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(reset) })
+    # Pauses hold even without a rate of our own
+    assert not bucket.take()
+    assert 4.0 < bucket.to_wait() <= 5.0
+
+def test_bucket_pauses_are_capped():
+    bucket = Bucket(10.0, 1)
+    bucket.pause(3600)
+    assert bucket.to_wait() <= 60.0
+
+def test_scheduler_lets_reads_go_before_writes():
+    async def main():
+        scheduler, log = Scheduler(50.0, 1), []
+        await scheduler.acquire(READ)
+        async def acquire(name, priority):
+            await scheduler.acquire(priority)
+            log.append(name)
+        write = asyncio.ensure_future(acquire('write', WRITE))
+        await asyncio.sleep(0)
+        read = asyncio.ensure_future(acquire('read', READ))
+        await asyncio.gather(write, read)
+        return log
+    # The write waited first, but the read takes the next token
+    assert run(main) == ['read', 'write']
@@ -0,0 +1,54 @@
+from conftest import to_person
+import state.state as S
+
+M = '/mockup/api/v1'
+
+def create(client, i, **fields):
+    person = to_person(None, email=f'p{i}@example.com', **fields)["person"]
+    person.pop("id")
+    client.post(f'{M}/people', json={ "person": person })
+
+def to_ids(r):
+    return [p["id"] for p in r.json()["results"]]
+
+def test_match_follows_updates_and_deletes(client):
+    create(client, 0)
+    create(client, 1)
+    r = client.get(f'{M}/people/match?format=json&email=P0@example.com')
+    assert r.json()["person"]["id"] == 0
+    client.put(f'{M}/people/0', json={ "person": { "email": "new@example.com" } })
+    r = client.get(f'{M}/people/match?format=json&email=p0@example.com')
+    assert r.status_code == 400 and r.json()["code"] == 'no_matches'
+    r = client.get(f'{M}/people/match?format=json&email=new@example.com')
+    assert r.json()["person"]["id"] == 0
+    client.put(f'{M}/people/1', json={ "person": { "email": "new@example.com" } })
+    r = client.get(f'{M}/people/match?format=json&email=new@example.com')
+    assert r.status_code == 400 and r.json()["code"] == 'multiple_matches'
+    client.delete(f'{M}/people/0')
+    r = client.get(f'{M}/people/match?format=json&email=new@example.com')
+    assert r.json()["person"]["id"] == 1
+
+def test_search_pages_newest_first(client):
+    for i in range(5):
+        create(client, i, party='D' if i % 2 else 'R', employer='E')
+    r = client.get(f'{M}/people/search?format=json&party=r&employer=e&limit=2')
+    assert to_ids(r) == [4, 2]
+    r = client.get(r.json()["next"].replace('/api/v1', M, 1) + '&format=json')
+    assert to_ids(r) == [0] and r.json()["next"] is None
+    r = client.get(f'{M}/people/search?format=json&last_name=nobody')
+    assert to_ids(r) == []
+    assert client.get(f'{M}/people/search?format=json').status_code == 400
+
+def test_indexes_are_rebuilt_on_load(client):
+    for i in range(3): create(client, i, last_name=f'L{i % 2}')
+    S.CACHE.entries.clear()
+    r = client.get(f'{M}/people/search?format=json&last_name=l0')
+    assert to_ids(r) == [2, 0]
+
+def test_proxy_search(client):
+    for i in range(3): create(client, i, party='D' if i else 'R')
+    r = client.get('/api/people/search?party=D&ignored=1')
+    assert to_ids(r) == [2, 1]
+    r = client.get('/api/people/match?email=p0@example.com')
+    assert r.json()["person"]["id"] == 0
+    assert client.get('/api/people/match?email=none@example.com').status_code == 400
@@ -0,0 +1,53 @@
+from util.token import TokenStore
+from types import SimpleNamespace
+import asyncio
+import httpx
+import pytest
+import time
+
+def run(main):
+    return asyncio.run(main())
+
+def to_store(session, status_code=200, calls=None):
+    calls = [] if calls is None else calls
+    async def exchange(request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        payload = { "access_token": "new", "refresh_token": "r2", "expires_in": 3600 }
+        return httpx.Response(status_code, json=payload)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(exchange))
+    config = SimpleNamespace(**{
+        "access_token_url": "http://localhost/oauth/token",
+        "client_id": "id", "client_secret": "secret", "redirect": "http://localhost"
+    })
+    service = SimpleNamespace(config=config, to_client=lambda: client)
+    stored = { "session": session, "saved": [] }
+    def save(session):
+        stored["saved"].append(session)
+        stored["session"] = session
+    return TokenStore(service, lambda: stored["session"], save), stored
+
+def test_concurrent_refreshes_share_one_exchange():
+    calls = []
+    session = { "token": "old", "refresh_token": "r1", "expires_at": time.time() + 30 }
+    store, stored = to_store(session, calls=calls)
+    async def main():
+        return await asyncio.gather(*[store.get() for _ in range(5)])
+    assert run(main) == ["new"] * 5
+    assert len(calls) == 1 and len(stored["saved"]) == 1
+    assert store.refreshing is None
+
+def test_fresh_tokens_are_not_refreshed():
+    calls = []
+    session = { "token": "old", "refresh_token": "r1", "expires_at": time.time() + 3600 }
+    store, _ = to_store(session, calls=calls)
+    assert run(store.get) == "old" and calls == []
+
+def test_failed_refreshes_keep_unexpired_tokens():
+    session = { "token": "old", "refresh_token": "r1", "expires_at": time.time() + 30 }
+    store, _ = to_store(session, status_code=500)
+    assert run(store.get) == "old"
+    session = { "token": "old", "refresh_token": "r1", "expires_at": time.time() - 1 }
+    store, _ = to_store(session, status_code=500)
+    with pytest.raises(httpx.HTTPStatusError):
+        run(store.get)
@@ -2,3 +2,14 @@ from .config import to_config
 from .config import set_config
 from .service import to_service
 from functools import lru_cache
+from .dispatch import to_dispatcher
+from .dispatch import QueueFull
+from .service import UpstreamError
+from .ratelimit import Bucket
+from .cache import to_response_cache
+from .token import to_token_store
+from .assets import to_asset
+from .metrics import to_metrics
+from .profiling import to_profiler
+from .stream import to_broker, to_sse
+from .coalesce import to_coalescer
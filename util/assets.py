@@ -0,0 +1,89 @@
+from pathlib import Path
+import hashlib
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MEDIA_TYPES = {
+    '.html': 'text/html',
+    '.js': 'text/javascript'
+}
+# Best compression first; identity is always available
+ENCODINGS = ['br', 'gzip', 'identity']
+# Versioned URLs never change, so browsers may keep them for a year
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+ASSETS = {}
+
+class Asset():
+    def __init__(self, body, media_type, stamp):
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.media_type = media_type
+        self.stamp = stamp
+        self.bodies = { 'identity': body }
+        compressed = { 'gzip': gzip.compress(body, 9, mtime=0) }
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        # Keep only variants that are actually smaller
+        for encoding, data in compressed.items():
+            if len(data) < len(body): self.bodies[encoding] = data
+
+    def to_etag(self, encoding):
+        if encoding == 'identity': return f'"{self.version}"'
+        return f'"{self.version}-{encoding}"'
+
+    def to_cache_control(self, version):
+        # Only URLs carrying the current version are cached for good
+        return IMMUTABLE if version == self.version else REVALIDATE
+
+    def to_encoding(self, accept_encoding):
+        accepted = to_accepted(accept_encoding)
+        for encoding in ENCODINGS:
+            if encoding not in self.bodies: continue
+            q = accepted.get(encoding, accepted.get('*', None))
+            if encoding == 'identity' and q is None: return encoding
+            if q: return encoding
+        return 'identity'
+
+def to_accepted(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name: continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key != 'q': continue
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+def to_stamp(paths):
+    stamps = []
+    for path in paths:
+        stat = Path(path).stat()
+        stamps.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+def to_asset(path, links=()):
+    # Rebuilt only when the file, or a linked asset, changes on disk
+    key = (path, tuple(links))
+    stamp = to_stamp([path, *links])
+    cached = ASSETS.get(key, None)
+    if cached is not None and cached.stamp == stamp: return cached
+    body = Path(path).read_bytes()
+    for link in links:
+        # Pages refer to scripts by versioned URLs
+        name = Path(link).name
+        version = to_asset(link).version
+        old, new = f'"./{name}"', f'"./{name}?v={version}"'
+        body = body.replace(old.encode('utf-8'), new.encode('utf-8'))
+    media_type = MEDIA_TYPES.get(Path(path).suffix, 'application/octet-stream')
+    ASSETS[key] = Asset(body, media_type, stamp)
+    return ASSETS[key]
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from functools import lru_cache
+import time
+
+class ResponseCache():
+    def __init__(self, ttl, max_bytes):
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.misses = 0
+        self.hits = 0
+
+    def to_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes
+        }
+
+    def to_generation(self, resource):
+        return self.generations.get(resource, 0)
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[0] < time.monotonic():
+            self.drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[2], entry[3]
+
+    def set(self, key, resource, body, generation, etag=None):
+        # Skip bodies read before the latest write to their resource
+        if generation != self.to_generation(resource): return
+        if self.ttl <= 0 or len(body) > self.max_bytes: return
+        self.drop(key)
+        expires = time.monotonic() + self.ttl
+        self.entries[key] = (expires, resource, body, etag)
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None: self.bytes -= len(entry[2])
+
+    def invalidate(self, resource):
+        self.generations[resource] = self.to_generation(resource) + 1
+        stale = [k for k, e in self.entries.items() if e[1] == resource]
+        for key in stale: self.drop(key)
+
+
+@lru_cache()
+def to_response_cache(config):
+    # One response cache per configuration
+    return ResponseCache(config.cache_ttl, config.cache_bytes)
@@ -0,0 +1,53 @@
+from .metrics import to_metrics
+from functools import lru_cache
+
+WRITES_COALESCED = to_metrics().counter(
+    'write_jobs_coalesced_total', 'Proxy writes merged into a pending write',
+    ('resource',)
+)
+
+class Coalescer():
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.merged = 0
+        self.sent = 0
+
+    def to_stats(self):
+        return {
+            "window": self.window,
+            "pending": len(self.pending),
+            "merged": self.merged,
+            "sent": self.sent
+        }
+
+    def to_held(self, target):
+        pending = self.pending.get(target, None)
+        return None if pending is None else pending[0]
+
+    def merge(self, resource, target, update):
+        to_merged(self.pending[target][1], update)
+        WRITES_COALESCED.inc(resource)
+        self.merged += 1
+
+    def hold(self, target, job_id, update):
+        self.pending[target] = (job_id, update)
+
+    def release(self, target, job_id):
+        # Updates after this point start a new write
+        if self.to_held(target) == job_id: del self.pending[target]
+        self.sent += 1
+
+def to_merged(base, update):
+    # Later fields win, and nested objects merge field by field
+    for k, v in update.items():
+        if isinstance(v, dict) and isinstance(base.get(k, None), dict):
+            to_merged(base[k], v)
+        else:
+            base[k] = v
+    return base
+
+@lru_cache()
+def to_coalescer(config):
+    # One set of pending writes per configuration
+    return Coalescer(config.coalesce_window)
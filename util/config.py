@@ -25,6 +25,29 @@ class Config(BaseSettings):
     client_secret: str
     authorize_url: str
     access_token_url: str
+    pool_size: int = 10
+    timeout: float = 10.0
+    concurrency: int = 4
+    queue_size: int = 1000
+    coalesce_window: float = 0.25
+    rate_limit: float = 10.0
+    rate_burst: int = 10
+    retries: int = 3
+    mock_rate_limit: float = 0.0
+    mock_rate_burst: int = 10
+    cache_ttl: float = 30.0
+    cache_bytes: int = 64 * 1024 * 1024
+    mock_token_ttl: int = 7200
+    workers: int = 1
+    launched_at: float = 0.0
+    profile_rate: float = 0.0
+    profile_dir: str = 'profiles'
+    profile_header: bool = False
+
+    class Config:
+        # Hashable, so per-configuration factories can cache on it
+        frozen = True
+
     def __init__(self, **kwargs):
         protocol = kwargs["protocol"]
         base_url = self.to_base_url(**kwargs)
@@ -37,5 +60,5 @@ class Config(BaseSettings):
         super().__init__(**kwargs)
 
     def to_base_url(self, **kwargs):
-        if kwargs['local']: return "localhost:8080/mockup"
+        if kwargs['local']: return f"localhost:{kwargs['port']}/mockup"
         return f"{kwargs['nation']}.nationbuilder.com"
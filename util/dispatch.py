@@ -0,0 +1,152 @@
+from .metrics import to_metrics
+from .profiling import track
+from collections import OrderedDict
+from uuid import uuid4
+from functools import lru_cache
+import asyncio
+import time
+
+# Finished jobs kept for status lookups
+JOB_HISTORY = 10000
+JOB_WAIT = to_metrics().histogram(
+    'write_job_wait_seconds', 'Time proxy writes spend queued'
+)
+JOB_SECONDS = to_metrics().histogram(
+    'write_job_seconds', 'Time proxy writes spend running', ('status',)
+)
+
+class QueueFull(Exception):
+    pass
+
+class Job():
+    def __init__(self, target):
+        self.id = uuid4().hex
+        self.target = target
+        self.status = "queued"
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.status_code = None
+        self.error = None
+        self.task = None
+
+    def start(self):
+        self.status = "running"
+        self.started_at = time.time()
+        JOB_WAIT.observe(self.started_at - self.queued_at)
+
+    def finish(self, result):
+        # Writes return nothing when there is no token to send them with
+        if result is None: self.error = "no token"
+        self.status_code = getattr(result, "status_code", None)
+        failed = result is None or (self.status_code or 0) >= 400
+        self.status = "failed" if failed else "done"
+        self.finished_at = time.time()
+        JOB_SECONDS.observe(self.finished_at - self.started_at, self.status)
+
+    def fail(self, error):
+        self.status = "failed"
+        self.error = f'{type(error).__name__}: {error}'
+        self.finished_at = time.time()
+        JOB_SECONDS.observe(self.finished_at - self.started_at, self.status)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "target": self.target,
+            "status": self.status,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "status_code": self.status_code,
+            "error": self.error
+        }
+
+class Dispatcher():
+    def __init__(self, concurrency, queue_size, history=JOB_HISTORY):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.history = history
+        # Called with each job once it finishes
+        self.listeners = []
+        self.jobs = OrderedDict()
+        self.tails = {}
+        self.pending = 0
+        self.running = 0
+
+    def to_stats(self):
+        return {
+            "queued": self.pending - self.running,
+            "running": self.running,
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size
+        }
+
+    def has_room(self, count):
+        return self.pending + count <= self.queue_size
+
+    def to_job(self, job_id):
+        return self.jobs.get(job_id, None)
+
+    def is_last(self, target, job):
+        # No other write to the target is queued behind this one
+        return job.task is not None and self.tails.get(target, None) is job.task
+
+    def submit(self, target, make, delay=0.0):
+        if self.pending >= self.queue_size:
+            raise QueueFull()
+        job = Job(target)
+        self.remember(job)
+        # Writes to the same target wait for the previous one
+        previous = self.tails.get(target, None)
+        task = asyncio.ensure_future(self.run(job, previous, make, delay))
+        track(task)
+        # Callers may await the task for the upstream response
+        job.task = task
+        task.add_done_callback(lambda t: setattr(job, 'task', None))
+        if target is not None:
+            self.tails[target] = task
+            task.add_done_callback(lambda t: self.forget(target, t))
+        self.pending += 1
+        return job
+
+    async def run(self, job, previous, make, delay):
+        try:
+            # Held back so later writes can join this one
+            if delay > 0: await asyncio.sleep(delay)
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self.semaphore:
+                self.running += 1
+                job.start()
+                try:
+                    result = await make()
+                    job.finish(result)
+                    return result
+                except Exception as e:
+                    job.fail(e)
+                finally:
+                    self.running -= 1
+        finally:
+            self.pending -= 1
+            for listener in self.listeners: listener(job)
+
+    def remember(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.finished_at is None: break
+            self.jobs.popitem(last=False)
+
+    def forget(self, target, task):
+        if self.tails.get(target, None) is task:
+            del self.tails[target]
+
+@lru_cache()
+def to_dispatcher(config):
+    # One dispatcher, and write queue, per configuration
+    return Dispatcher(**{
+        "concurrency": config.concurrency,
+        "queue_size": config.queue_size
+    })
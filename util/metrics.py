@@ -0,0 +1,119 @@
+from bisect import bisect_left
+from threading import Lock
+
+# Latency buckets, in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def to_lines(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f'{self.name}{to_labels(self.labels, labels)} {value}'
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+
+    def observe(self, value, *labels):
+        # One bisect and three increments per observation
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels, None)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[labels] = series
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def to_lines(self):
+        with self.lock:
+            series = [(k, list(v[0]), v[1], v[2]) for k, v in self.series.items()]
+        for labels, counts, total, count in series:
+            cumulative = 0
+            bounds = [*map(repr, self.buckets), '+Inf']
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                names = (*self.labels, 'le')
+                tags = to_labels(names, (*labels, bound))
+                yield f'{self.name}_bucket{tags} {cumulative}'
+            tags = to_labels(self.labels, labels)
+            yield f'{self.name}_sum{tags} {total}'
+            yield f'{self.name}_count{tags} {count}'
+
+class Sampled():
+    # Values read from elsewhere when metrics are scraped
+    def __init__(self, kind, name, help, labels, collect):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def to_lines(self):
+        for labels, value in self.collect():
+            yield f'{self.name}{to_labels(self.labels, labels)} {value}'
+
+class Metrics():
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=()):
+        return self.add(Histogram(name, help, labels))
+
+    def sampled(self, kind, name, help, labels, collect):
+        return self.add(Sampled(kind, name, help, labels, collect))
+
+    def to_text(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.to_lines())
+        return '\n'.join(lines) + '\n'
+
+def to_labels(names, values):
+    if not names: return ''
+    pairs = [f'{k}="{to_escaped(v)}"' for k, v in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+def to_escaped(value):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"')
+
+
+METRICS = Metrics()
+
+def to_metrics():
+    # One registry per process, shared by every module
+    return METRICS
@@ -0,0 +1,130 @@
+from collections import Counter
+from contextvars import ContextVar
+from threading import Thread, Event
+from pathlib import Path
+from uuid import uuid4
+from functools import lru_cache
+import cProfile
+import asyncio
+import random
+import time
+import sys
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.001
+# Seconds to wait for background writes started by a profiled request
+BACKGROUND_WAIT = 10.0
+# Seconds before a profile is cut off, for responses that never end
+PROFILE_LIMIT = 30.0
+# Tasks started while handling a profiled request
+PENDING = ContextVar('profiled_tasks', default=None)
+
+class Sampler(Thread):
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+
+    def run(self):
+        # Samples every thread, so pooled and state work shows up too
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident: continue
+                self.stacks[to_stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Profile():
+    def __init__(self, route):
+        self.route = route
+        self.profile = cProfile.Profile()
+        self.sampler = Sampler()
+        self.started = None
+        self.deadline = None
+        self.finishing = False
+        self.pending = []
+
+    def start(self):
+        self.started = time.time()
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self, directory):
+        self.profile.disable()
+        self.sampler.stop()
+        folder = Path(directory).joinpath(to_slug(self.route))
+        folder.mkdir(parents=True, exist_ok=True)
+        name = f'{int(self.started * 1000)}-{uuid4().hex[:8]}'
+        self.profile.dump_stats(folder.joinpath(f'{name}.prof'))
+        lines = [f'{s} {n}\n' for s, n in self.sampler.stacks.items()]
+        folder.joinpath(f'{name}.collapsed').write_text(''.join(lines))
+
+class Profiler():
+    def __init__(self, rate, directory, header):
+        self.directory = directory
+        self.header = header
+        self.rate = rate
+        self.active = None
+
+    def is_enabled(self):
+        return self.rate > 0 or self.header
+
+    def is_sampled(self, headers):
+        # The interpreter supports one profiler at a time
+        if self.active is not None: return False
+        if self.header and headers.get('x-profile', '') in ('1', 'true'):
+            return True
+        return random.random() < self.rate
+
+    def start(self, route, limit=PROFILE_LIMIT):
+        self.active = Profile(route)
+        # Only this request's task, and tasks it starts, see the list
+        PENDING.set(self.active.pending)
+        self.active.start()
+        loop = asyncio.get_running_loop()
+        self.active.deadline = loop.call_later(limit, self.finish)
+
+    def finish(self):
+        # Detached, so responses are not held up by their background writes
+        active = self.active
+        if active is None or active.finishing: return
+        active.finishing = True
+        active.deadline.cancel()
+        asyncio.ensure_future(self.stop())
+
+    async def stop(self):
+        try:
+            # Background writes count towards the request that queued them
+            pending = self.active.pending
+            running = [task for task in pending if not task.done()]
+            if running:
+                await asyncio.wait(running, timeout=BACKGROUND_WAIT)
+            self.active.stop(self.directory)
+        finally:
+            self.active = None
+
+def track(task):
+    pending = PENDING.get()
+    if pending is not None: pending.append(task)
+
+def to_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f'{module}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def to_slug(route):
+    slug = ''.join(c if c.isalnum() else '_' for c in route).strip('_')
+    return slug or 'root'
+
+@lru_cache()
+def to_profiler(config):
+    # One profiler per configuration
+    rate, header = config.profile_rate, config.profile_header
+    return Profiler(rate, config.profile_dir, header)
@@ -0,0 +1,106 @@
+import asyncio
+import random
+import time
+
+READ = 0
+WRITE = 1
+# Never trust a server to pause us for longer than this
+MAX_PAUSE = 60.0
+
+class Bucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+        return now
+
+    def to_wait(self):
+        now = self.refill()
+        if now < self.paused_until:
+            return self.paused_until - now
+        # A rate of 0 is no limit, short of pauses the server asks for
+        if self.rate <= 0 or self.tokens >= 1: return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.to_wait() > 0: return False
+        if self.rate > 0: self.tokens -= 1
+        return True
+
+    def to_remaining(self):
+        self.refill()
+        return int(self.tokens)
+
+    def to_reset(self):
+        # Wall clock time when the next request is allowed
+        return time.time() + self.to_wait()
+
+    def pause(self, seconds):
+        now = time.monotonic()
+        seconds = min(max(seconds, 0.0), MAX_PAUSE)
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def update(self, headers):
+        remaining = to_number(headers.get('x-ratelimit-remaining'))
+        reset = to_number(headers.get('x-ratelimit-reset'))
+        if remaining is None: return
+        self.refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining < 1 and reset is not None:
+            self.pause(reset - time.time())
+
+class Scheduler():
+    def __init__(self, rate, burst):
+        self.bucket = Bucket(rate, burst)
+        self.waiting = [0, 0]
+        self.condition = None
+
+    def to_condition(self):
+        # Created lazily, inside the event loop that will use it
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    async def acquire(self, priority):
+        condition = self.to_condition()
+        async with condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    # Reads go before any waiting writes
+                    if any(self.waiting[:priority]):
+                        await condition.wait()
+                        continue
+                    if self.bucket.take(): return
+                    wait = self.bucket.to_wait()
+                    try:
+                        await asyncio.wait_for(condition.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.waiting[priority] -= 1
+                condition.notify_all()
+
+    def update(self, headers):
+        self.bucket.update(headers)
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_backoff(attempt, base=0.25, cap=10.0):
+    # Full jitter, so concurrent retries spread out
+    return random.uniform(0, min(cap, base * 2 ** attempt))
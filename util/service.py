@@ -1,5 +1,33 @@
+from .ratelimit import Scheduler, READ, WRITE
+from .ratelimit import to_backoff, to_number
+from .metrics import to_metrics
+from collections import OrderedDict
 from rauth import OAuth2Service
+from functools import lru_cache
+import asyncio
+import httpx
 import json
+import time
+
+# Largest page size Nationbuilder allows
+PAGE_LIMIT = 100
+# Only idempotent calls are retried after upstream errors
+IDEMPOTENT = {'GET', 'PUT', 'DELETE'}
+RETRY_STATUS = {502, 503, 504}
+# Pages remembered for conditional requests
+VALIDATOR_LIMIT = 1024
+UPSTREAM_SECONDS = to_metrics().histogram(
+    'upstream_request_seconds', 'Nationbuilder API call latency', ('method',)
+)
+UPSTREAM_RESPONSES = to_metrics().counter(
+    'upstream_responses_total', 'Nationbuilder API responses', ('method', 'status')
+)
+
+class UpstreamError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(f'{status_code}: {detail}')
+        self.status_code = status_code
+        self.detail = detail
 
 class Service():
     def __init__(self, config, service):
@@ -7,44 +35,172 @@ class Service():
             "redirect_uri": config.redirect,
             "response_type": "code"
         })
+        self.limits = httpx.Limits(**{
+            "max_connections": config.pool_size,
+            "max_keepalive_connections": config.pool_size
+        })
+        self.timeout = httpx.Timeout(config.timeout)
+        self.validators = OrderedDict()
+        self.schedulers = {}
         self.oauth = service
         self.config = config
+        self.client = None
+
+    def to_client(self):
+        # Created lazily, inside the event loop that will use it
+        if self.client is None:
+            self.client = httpx.AsyncClient(**{
+                "headers": {'content-type': 'application/json'},
+                "timeout": self.timeout,
+                "limits": self.limits
+            })
+        return self.client
+
+    async def close(self):
+        if self.client is None: return
+        await self.client.aclose()
+        self.client = None
 
-    async def delete_api(self, token, endpoint):
+    def to_scheduler(self, token):
+        # Nationbuilder limits each access token separately
+        if token not in self.schedulers:
+            rate, burst = self.config.rate_limit, self.config.rate_burst
+            self.schedulers[token] = Scheduler(rate, burst)
+        return self.schedulers[token]
+
+    async def request(self, token, method, target, timeout=None, **kwargs):
+        params = { **kwargs.pop('params', {}), 'access_token': token }
+        priority = READ if method == 'GET' else WRITE
+        if timeout is not None: kwargs['timeout'] = timeout
+        scheduler = self.to_scheduler(token)
+        retries = self.config.retries
+        client = self.to_client()
+        for attempt in range(retries + 1):
+            await scheduler.acquire(priority)
+            started = time.perf_counter()
+            try:
+                r = await client.request(method, target, params=params, **kwargs)
+            except httpx.TransportError as e:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, method)
+                UPSTREAM_RESPONSES.inc(method, type(e).__name__)
+                # Unsent requests are always safe to retry
+                unsent = isinstance(e, httpx.ConnectError)
+                safe = unsent or method in IDEMPOTENT
+                if attempt >= retries or not safe: raise
+                await asyncio.sleep(to_backoff(attempt))
+                continue
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, method)
+            UPSTREAM_RESPONSES.inc(method, r.status_code)
+            scheduler.update(r.headers)
+            if attempt >= retries: return r
+            if r.status_code == 429:
+                retry_after = to_number(r.headers.get('retry-after'))
+                wait = to_backoff(attempt) if retry_after is None else retry_after
+                scheduler.pause(wait)
+                continue
+            if r.status_code in RETRY_STATUS and method in IDEMPOTENT:
+                await asyncio.sleep(to_backoff(attempt))
+                continue
+            return r
+
+    async def delete_api(self, token, endpoint, timeout=None):
         if token is None: return
-        session = self.oauth.get_session(token)
         target = self.config.api_url + endpoint
-        session.delete(target)
+        return await self.request(token, 'DELETE', target, timeout)
 
-    async def put_api(self, token, endpoint, data):
+    async def put_api(self, token, endpoint, data, timeout=None):
         if token is None: return
-        headers = {'content-type': 'application/json'}
-        session = self.oauth.get_session(token)
         target = self.config.api_url + endpoint
-        session.put(target, json=data, headers=headers)
+        return await self.request(token, 'PUT', target, timeout, **to_body(data))
 
-    async def post_api(self, token, endpoint, data):
+    async def post_api(self, token, endpoint, data, timeout=None):
         if token is None: return
-        headers = {'content-type': 'application/json'}
-        session = self.oauth.get_session(token)
         target = self.config.api_url + endpoint
-        session.post(target, json=data, headers=headers)
+        return await self.request(token, 'POST', target, timeout, **to_body(data))
 
-    def get_api(self, token, endpoint):
+    def remember(self, key, page, etag):
+        self.validators.pop(key, None)
+        if etag is None: return
+        self.validators[key] = (page, etag)
+        while len(self.validators) > VALIDATOR_LIMIT:
+            self.validators.popitem(last=False)
+
+    async def get_page(self, token, target, params, timeout=None):
+        params = {'format': 'json', **params}
+        key = (token, target, tuple(sorted(params.items())))
+        cached = self.validators.get(key, None)
+        headers = {} if cached is None else {'if-none-match': cached[1]}
+        try:
+            r = await self.request(**{
+                "token": token, "method": 'GET', "target": target,
+                "timeout": timeout, "params": params, "headers": headers
+            })
+        except httpx.HTTPError as e:
+            raise UpstreamError(502, f'{type(e).__name__}: {e}')
+        # Unchanged pages reuse the body from last time
+        if r.status_code == 304 and cached is not None:
+            self.validators.move_to_end(key)
+            return cached
+        if r.status_code >= 400:
+            raise UpstreamError(r.status_code, r.text)
+        try:
+            page = json.loads(r.content.decode('utf-8'))
+        except ValueError as e:
+            raise UpstreamError(502, f'Invalid JSON: {e}')
+        etag = r.headers.get('etag', None)
+        self.remember(key, page, etag)
+        return page, etag
+
+    async def get_api(self, token, endpoint, timeout=None, params=None):
         if token is None: return dict()
-        params = {'format': 'json'}
-        headers = {'content-type': 'application/json'}
-        session = self.oauth.get_session(token)
         target = self.config.api_url + endpoint
+        page, _ = await self.get_page(token, target, params or {}, timeout)
+        return page
+
+    async def iter_api(
+            self, token, endpoint, limit=PAGE_LIMIT, timeout=None, etags=None,
+            params=None
+        ):
+        if token is None: return
+        # Next links are paths on the nation's host
+        origin = f'{self.config.protocol}{self.config.base_url}'
+        def fetch(target, params):
+            page = self.get_page(token, target, params, timeout)
+            return asyncio.ensure_future(page)
+        target = self.config.api_url + endpoint
+        pending = fetch(target, {**(params or {}), 'limit': limit})
         try:
-            r = session.get(target, params=params, headers=headers)
-            return json.loads(r._content.decode('utf-8')) 
-        except Exception as e:
-            print('what?')
-            return dict()
+            while pending is not None:
+                page, etag = await pending
+                pending = None
+                if etags is not None: etags.append(etag)
+                # Prefetch the next page while this one is consumed
+                if page.get("next", None):
+                    pending = fetch(origin + page["next"], {})
+                yield page.get("results", [])
+        finally:
+            if pending is not None: pending.cancel()
+
+    async def iter_changes(self, token, since=None, limit=PAGE_LIMIT, params=None):
+        # Pages of changes, each with the cursor to resume from later
+        if token is None: return
+        params = {**(params or {}), 'limit': limit}
+        while True:
+            if since is not None: params['since'] = since
+            page = await self.get_api(token, '/changes', params=params)
+            since = page.get("since", since)
+            yield page.get("results", []), since
+            if not page.get("next", None): return
+
 
+def to_body(data):
+    # Serialized bodies are sent as they are
+    if isinstance(data, bytes): return { "content": data }
+    return { "json": data }
 
+@lru_cache()
 def to_service(config):
+    # One long-lived service, and connection pool, per configuration
     service = OAuth2Service(
             name = config.nation,
             base_url = config.base_url,
@@ -0,0 +1,49 @@
+from functools import lru_cache
+import asyncio
+import json
+
+class Subscriber():
+    def __init__(self):
+        self.ready = asyncio.Event()
+
+    def wake(self):
+        self.ready.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.ready.clear()
+
+class Broker():
+    def __init__(self):
+        self.subscribers = set()
+
+    def to_stats(self):
+        return { "clients": len(self.subscribers) }
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def wake(self):
+        # Clients read new events from shared state, sooner than their poll
+        for subscriber in self.subscribers:
+            subscriber.wake()
+
+def to_sse(event, data, event_id=None):
+    if not isinstance(data, bytes):
+        data = json.dumps(data).encode('utf-8')
+    lines = [] if event_id is None else [f'id: {event_id}'.encode('utf-8')]
+    lines += [f'event: {event}'.encode('utf-8'), b'data: ' + data]
+    return b'\n'.join(lines) + b'\n\n'
+
+@lru_cache()
+def to_broker(config):
+    # One broker, and set of stream clients, per configuration
+    return Broker()
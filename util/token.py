@@ -0,0 +1,82 @@
+from functools import lru_cache
+import asyncio
+import time
+
+# Refresh tokens this many seconds before they expire
+REFRESH_MARGIN = 60.0
+
+class TokenStore():
+    def __init__(self, service, load, save):
+        self.service = service
+        self.config = service.config
+        self.refreshing = None
+        self.session = None
+        self.load = load
+        self.save = save
+
+    def to_session(self):
+        # Read each time, since other workers may authorize or refresh
+        self.session = self.load()
+        return self.session
+
+    def is_expiring(self, session):
+        expires_at = session.get("expires_at", None)
+        if expires_at is None: return False
+        return expires_at - time.time() < REFRESH_MARGIN
+
+    async def get(self):
+        session = self.to_session()
+        if session is None: return None
+        if session.get("refresh_token") and self.is_expiring(session):
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep using a token that has not yet expired
+                if session["expires_at"] < time.time(): raise
+        return self.session["token"]
+
+    async def refresh(self):
+        # Concurrent callers share one token exchange
+        if self.refreshing is None:
+            refresh_token = self.session["refresh_token"]
+            self.refreshing = asyncio.ensure_future(self.exchange(**{
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token
+            }))
+            self.refreshing.add_done_callback(self.on_refreshed)
+        await asyncio.shield(self.refreshing)
+
+    def on_refreshed(self, future):
+        self.refreshing = None
+
+    async def exchange(self, **data):
+        client = self.service.to_client()
+        headers = {'content-type': 'application/x-www-form-urlencoded'}
+        r = await client.post(self.config.access_token_url, headers=headers, data={
+            **data,
+            "client_id": self.config.client_id,
+            "client_secret": self.config.client_secret,
+            "redirect_uri": self.config.redirect
+        })
+        r.raise_for_status()
+        self.set(r.json())
+        return self.session["token"]
+
+    def set(self, payload):
+        session = { "token": payload["access_token"] }
+        refresh_token = payload.get("refresh_token", None)
+        expires_in = payload.get("expires_in", None)
+        if refresh_token is not None:
+            session["refresh_token"] = refresh_token
+        if expires_in is not None:
+            session["expires_at"] = time.time() + float(expires_in)
+        # Only changed tokens are written to disk
+        if session != self.session:
+            self.save(session)
+        self.session = session
+
+
+@lru_cache()
+def to_token_store(service, load, save):
+    # One token store per configuration's service
+    return TokenStore(service, load, save)